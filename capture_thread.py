@@ -0,0 +1,147 @@
+
+"""
+Capture RealSense dans un thread
+
+Le thread de capture attend les images, les aligne, et les copie dans un
+triple buffer préalloué. La boucle Posenet prend toujours la capture la plus
+récente: si Posenet est plus lent que la caméra, les captures intermédiaires
+sont perdues, et comptées, au lieu de s'accumuler dans la file de la caméra.
+
+En veille, raw = True: ni décimation ni alignement, seule la profondeur
+brute est copiée, sans la couleur.
+"""
+
+
+from time import time
+from threading import Thread, Condition
+
+import numpy as np
+
+
+class FrameMailbox:
+    """Triple buffer: un slot pour le producteur, un slot pour la dernière
+    capture publiée, un slot pour le consommateur.
+    """
+
+    def __init__(self):
+
+        self.colors = None
+        self.depths = None
+        # Profondeur brute de la veille, et les slots qui en contiennent
+        self.raw_depths = None
+        self.raws = np.zeros(3, dtype=bool)
+        self.times = np.zeros(3)
+
+        self.write_slot = 0
+        self.ready_slot = 1
+        self.read_slot = 2
+
+        # Numéro de la dernière capture publiée, et de la dernière lue
+        self.seq = 0
+        self.read_seq = 0
+        # Nombre de captures jamais lues
+        self.dropped = 0
+
+        self.condition = Condition()
+
+    def allocate(self, color, depth):
+        """Allocation à la première capture, avec sa taille"""
+
+        self.colors = np.empty((3,) + color.shape, dtype=color.dtype)
+        self.depths = np.empty((3,) + depth.shape, dtype=depth.dtype)
+
+    def put(self, color, depth, t):
+        """Copie la capture dans le slot du producteur, puis la publie
+        color = None pour une profondeur brute de la veille
+        """
+        if color is None:
+            if self.raw_depths is None:
+                self.raw_depths = np.empty((3,) + depth.shape, dtype=depth.dtype)
+            np.copyto(self.raw_depths[self.write_slot], depth)
+        else:
+            if self.colors is None:
+                self.allocate(color, depth)
+            np.copyto(self.colors[self.write_slot], color)
+            np.copyto(self.depths[self.write_slot], depth)
+        self.raws[self.write_slot] = color is None
+        self.times[self.write_slot] = t
+
+        with self.condition:
+            self.write_slot, self.ready_slot = self.ready_slot, self.write_slot
+            self.seq += 1
+            self.condition.notify()
+
+    def get(self, timeout=1):
+        """Retourne color, depth, t de la capture la plus récente,
+        ou None, None, None si rien de nouveau avant timeout.
+        color est None pour une profondeur brute de la veille.
+        Les arrays restent valables jusqu'au get suivant.
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.seq > self.read_seq,
+                                           timeout):
+                return None, None, None
+
+            self.read_slot, self.ready_slot = self.ready_slot, self.read_slot
+            self.dropped += self.seq - self.read_seq - 1
+            self.read_seq = self.seq
+
+        if self.raws[self.read_slot]:
+            return (None,
+                    self.raw_depths[self.read_slot],
+                    self.times[self.read_slot])
+
+        return (self.colors[self.read_slot],
+                self.depths[self.read_slot],
+                self.times[self.read_slot])
+
+
+class CaptureThread:
+    """Attend les images de la caméra, les traite, les met dans la boîte"""
+
+    def __init__(self, pipeline, process, mailbox):
+        """process = fonction appliquée aux captures: décimation, alignement"""
+
+        self.pipeline = pipeline
+        self.process = process
+        self.mailbox = mailbox
+        self.capture_loop = 1
+        self.thread = None
+        # Veille: profondeur brute seulement, sans process
+        self.raw = False
+
+    def start(self):
+        print("Lancement du thread de capture")
+        self.thread = Thread(target=self.run)
+        self.thread.start()
+
+    def stop(self):
+        self.capture_loop = 0
+        if self.thread:
+            self.thread.join()
+
+    def run(self):
+        while self.capture_loop:
+            try:
+                frames = self.pipeline.wait_for_frames(timeout_ms=1000)
+            except RuntimeError:
+                # Pas d'image dans le temps imparti
+                continue
+            t = time()
+
+            if self.raw:
+                depth = frames.get_depth_frame()
+                if depth:
+                    self.mailbox.put(None, np.asanyarray(depth.get_data()), t)
+                continue
+
+            frames = self.process(frames)
+
+            color = frames.get_color_frame()
+            depth = frames.get_depth_frame()
+            if not color or not depth:
+                continue
+
+            self.mailbox.put(np.asanyarray(color.as_frame().get_data()),
+                             np.asanyarray(depth.as_frame().get_data()),
+                             t)
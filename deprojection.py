@@ -0,0 +1,164 @@
+
+"""
+Passage des pixels de l'image aux points 3D, avec numpy,
+comme rs2_deproject_pixel_to_point de librealsense (rsutil.h),
+et l'inverse avec project_points,
+mais pour tous les keypoints de tous les squelettes en une fois.
+
+Les rayons de tous les pixels sont calculés une seule fois avec les intrinsics,
+distorsion comprise: un point 3D = profondeur * (x_rayon, y_rayon, 1)
+
+Ne demande pas pyrealsense2, les intrinsics peuvent être celles d'une session
+relue par my_replay.
+"""
+
+
+import numpy as np
+
+
+# Précision de float de librealsense
+FLT_EPSILON = np.finfo(np.float32).eps
+
+
+def model_name(model):
+    """rs.distortion.inverse_brown_conrady ou 'inverse_brown_conrady'
+    --> 'inverse_brown_conrady'
+    """
+    return str(model).split('.')[-1]
+
+
+def deproject_pixels(intrinsic, pixels):
+    """pixels = array (..., 2) des x, y dans l'image
+    Retourne un array (..., 2) des x, y du rayon à la profondeur 1
+    """
+    model = model_name(intrinsic.model)
+    c = [float(k) for k in intrinsic.coeffs]
+
+    x = (pixels[..., 0] - intrinsic.ppx) / intrinsic.fx
+    y = (pixels[..., 1] - intrinsic.ppy) / intrinsic.fy
+    xo, yo = x, y
+
+    if model == 'modified_brown_conrady':
+        raise ValueError("Une image avec distorsion modifiée ne peut pas "
+                         "être déprojetée")
+
+    if model == 'inverse_brown_conrady':
+        # 10 itérations comme dans librealsense
+        for i in range(10):
+            r2 = x*x + y*y
+            icdist = 1 / (1 + ((c[4]*r2 + c[1])*r2 + c[0])*r2)
+            xq = x / icdist
+            yq = y / icdist
+            delta_x = 2*c[2]*xq*yq + c[3]*(r2 + 2*xq*xq)
+            delta_y = 2*c[3]*xq*yq + c[2]*(r2 + 2*yq*yq)
+            x = (xo - delta_x)*icdist
+            y = (yo - delta_y)*icdist
+
+    elif model == 'brown_conrady':
+        for i in range(10):
+            r2 = x*x + y*y
+            icdist = 1 / (1 + ((c[4]*r2 + c[1])*r2 + c[0])*r2)
+            delta_x = 2*c[2]*x*y + c[3]*(r2 + 2*x*x)
+            delta_y = 2*c[3]*x*y + c[2]*(r2 + 2*y*y)
+            x = (xo - delta_x)*icdist
+            y = (yo - delta_y)*icdist
+
+    elif model == 'kannala_brandt4':
+        rd = np.maximum(np.sqrt(x*x + y*y), FLT_EPSILON)
+        theta = rd.copy()
+        for i in range(4):
+            theta2 = theta*theta
+            f = theta*(1 + theta2*(c[0] + theta2*(c[1] + theta2*(c[2]
+                                             + theta2*c[3])))) - rd
+            df = 1 + theta2*(3*c[0] + theta2*(5*c[1] + theta2*(7*c[2]
+                                             + 9*theta2*c[3])))
+            theta = np.where(np.abs(f) < FLT_EPSILON, theta, theta - f/df)
+        r = np.tan(theta)
+        x = x*r/rd
+        y = y*r/rd
+
+    elif model == 'ftheta':
+        rd = np.maximum(np.sqrt(x*x + y*y), FLT_EPSILON)
+        r = np.tan(c[0]*rd) / np.arctan(2*np.tan(c[0]/2))
+        x = x*r/rd
+        y = y*r/rd
+
+    return np.stack((x, y), axis=-1)
+
+
+def project_points(intrinsic, points):
+    """Inverse de deproject_pixels, comme rs2_project_point_to_pixel
+    points = array (..., 3) des x, y, z
+    Retourne un array (..., 2) des x, y dans l'image
+    """
+    model = model_name(intrinsic.model)
+    c = [float(k) for k in intrinsic.coeffs]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = points[..., 0] / points[..., 2]
+        y = points[..., 1] / points[..., 2]
+
+    if model in ['modified_brown_conrady', 'inverse_brown_conrady']:
+        r2 = x*x + y*y
+        f = 1 + c[0]*r2 + c[1]*r2*r2 + c[4]*r2*r2*r2
+        x = x*f
+        y = y*f
+        dx = x + 2*c[2]*x*y + c[3]*(r2 + 2*x*x)
+        dy = y + 2*c[3]*x*y + c[2]*(r2 + 2*y*y)
+        x, y = dx, dy
+
+    elif model == 'brown_conrady':
+        r2 = x*x + y*y
+        f = 1 + c[0]*r2 + c[1]*r2*r2 + c[4]*r2*r2*r2
+        dx = x*f + 2*c[2]*x*y + c[3]*(r2 + 2*x*x)
+        dy = y*f + 2*c[3]*x*y + c[2]*(r2 + 2*y*y)
+        x, y = dx, dy
+
+    elif model == 'ftheta':
+        r = np.maximum(np.sqrt(x*x + y*y), FLT_EPSILON)
+        rd = 1/c[0]*np.arctan(2*r*np.tan(c[0]/2))
+        x = x*rd/r
+        y = y*rd/r
+
+    elif model == 'kannala_brandt4':
+        r = np.maximum(np.sqrt(x*x + y*y), FLT_EPSILON)
+        theta = np.arctan(r)
+        theta2 = theta*theta
+        series = 1 + theta2*(c[0] + theta2*(c[1] + theta2*(c[2] + theta2*c[3])))
+        rd = theta*series
+        x = x*rd/r
+        y = y*rd/r
+
+    return np.stack((x*intrinsic.fx + intrinsic.ppx,
+                     y*intrinsic.fy + intrinsic.ppy), axis=-1)
+
+
+class Deprojector:
+    """Table des rayons de tous les pixels de l'image"""
+
+    def __init__(self, intrinsic):
+
+        self.width = intrinsic.width
+        self.height = intrinsic.height
+
+        u, v = np.meshgrid(np.arange(self.width), np.arange(self.height))
+        pixels = np.stack((u, v), axis=-1).astype(np.float64)
+        # (h, w, 2) en float32 comme librealsense
+        self.rays = deproject_pixels(intrinsic, pixels).astype(np.float32)
+
+    def lift(self, xys, profondeurs):
+        """xys = array (N, 17, 2) int des x, y dans l'image
+        profondeurs = array (N, 17) en m, nan si pas de profondeur
+
+        Retourne un array (N, 17, 3) des x, y, z en mm, nan si pas de profondeur
+        """
+        u = np.clip(xys[..., 0], 0, self.width - 1)
+        v = np.clip(xys[..., 1], 0, self.height - 1)
+
+        points = np.empty(xys.shape[:-1] + (3,))
+        points[..., :2] = self.rays[v, u]
+        points[..., 2] = 1
+        # Conversion des m en mm
+        points *= 1000*profondeurs[..., np.newaxis]
+
+        return points
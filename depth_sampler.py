@@ -0,0 +1,79 @@
+
+"""
+Calcul de la profondeur de tous les keypoints de tous les squelettes
+en une seule fois, avec numpy, sur l'image de profondeur z16.
+
+Pour chaque keypoint, la profondeur est la moyenne des pixels d'un patch
+autour du point, sans les pixels sans profondeur (0), et sans les trim plus
+petites et trim plus grandes valeurs.
+"""
+
+
+import numpy as np
+
+
+class DepthSampler:
+    """Profondeurs des keypoints, en m, comme depth_frame.get_distance()"""
+
+    def __init__(self, around=1, trim=1, depth_scale=0.001):
+        """around = nombre de pixels autour du point, le patch est
+                    range(x - around, x + around) x range(y - around, y + around)
+        trim = nombre de valeurs supprimées en haut et en bas,
+               il faut plus de 2*trim valeurs valides pour avoir une profondeur
+        depth_scale = profondeur en m pour 1 en z16
+        """
+        self.around = around
+        self.trim = trim
+        self.depth_scale = depth_scale
+        self.set_patch()
+
+    def set_patch(self):
+        """Décalages en x et y de tous les pixels du patch"""
+
+        d = np.arange(-self.around, self.around)
+        du, dv = np.meshgrid(d, d)
+        self.du = du.ravel()
+        self.dv = dv.ravel()
+
+    def sample(self, depth, xys, valid, image_size=None):
+        """depth = array (h, w) uint16 de l'image de profondeur
+        xys = array (N, 17, 2) int des x, y dans l'image
+        valid = array (N, 17) bool, False pour les keypoints absents
+        image_size = (largeur, hauteur) de l'image des xys, si elle n'a pas
+                     la taille de la profondeur, les xys sont mis à l'échelle
+
+        Retourne un array (N, 17) des profondeurs en m, nan si pas trouvée
+        """
+        h, w = depth.shape[:2]
+
+        if image_size is not None and tuple(image_size) != (w, h):
+            # Profondeur décimée, ou de résolution différente de la couleur
+            scale = np.array([w / image_size[0], h / image_size[1]])
+            xys = (xys*scale).astype(np.int64)
+
+        # (N, 17, P) pour les P pixels du patch
+        u = xys[..., 0, np.newaxis] + self.du
+        v = xys[..., 1, np.newaxis] + self.dv
+        inside = valid[..., np.newaxis] & (u >= 0) & (u < w) & (v >= 0) & (v < h)
+        np.clip(u, 0, w - 1, out=u)
+        np.clip(v, 0, h - 1, out=v)
+
+        values = depth[v, u].astype(np.float64)
+        # Les 0 sont des pixels sans profondeur, rangés à la fin par le tri
+        values[~inside | (values == 0)] = np.inf
+        values.sort(axis=-1)
+        n = np.count_nonzero(values != np.inf, axis=-1)
+        values[values == np.inf] = 0
+
+        # Somme de trim à n - trim avec les sommes cumulées
+        cumsum = np.zeros(values.shape[:-1] + (values.shape[-1] + 1,))
+        np.cumsum(values, axis=-1, out=cumsum[..., 1:])
+        good = n > 2*self.trim
+        top = np.where(good, n - self.trim, self.trim)
+        somme = np.take_along_axis(cumsum, top[..., np.newaxis], axis=-1)[..., 0]
+        somme -= cumsum[..., self.trim]
+
+        profondeurs = np.full(n.shape, np.nan)
+        profondeurs[good] = somme[good] / (n[good] - 2*self.trim)
+
+        return profondeurs*self.depth_scale
@@ -23,6 +23,8 @@ class GesturesDetection(MyMovenet):
         self.config = config
         self.zoom = np.zeros((256, 256, 3), dtype = "uint8")
         self.move_loop = 1
+        # Personne devant la caméra, la boucle d'affichage ralentit
+        self.idle = 0
 
         # Calcul du FPS
         self.t_gest = time()
@@ -59,6 +61,12 @@ class GesturesDetection(MyMovenet):
                         if zoom.any():
                             self.get_gestures(zoom)
 
+                    elif data[0] == 'idle':
+                        print('idle reçu dans movenet:', data[1])
+                        self.idle = data[1]
+                        if self.idle:
+                            self.zoom = np.zeros((256, 256, 3), dtype = "uint8")
+
                     elif data[0] == 'threshold':
                         print('threshold reçu dans movenet:', data[1])
                         self.threshold_m = data[1]
@@ -97,7 +105,8 @@ class GesturesDetection(MyMovenet):
             self.nbr_gest += 1
             cv2.imshow('Movenet', self.zoom)
 
-            k = cv2.waitKey(36)
+            # 2 images par seconde en veille
+            k = cv2.waitKey(500 if self.idle else 36)
             # Pour quitter
             if k == 27:  # Esc
                 self.move_conn.send(['quit', 1])
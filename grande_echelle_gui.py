@@ -101,6 +101,10 @@ class MainScreen(Screen):
                         if data1[0] == 'zoom':
                             self.p3_conn.send(['zoom', data1[1]])
 
+                        # Relais de la veille
+                        elif data1[0] == 'idle':
+                            self.p3_conn.send(['idle', data1[1]])
+
                         elif data1[0] == 'quit':
                             print("\nQuit reçu dans Kivy de Posenet Realsense ")
                             # Fait le quit dans PoseRealsense avec le quit
@@ -197,6 +201,7 @@ class ReglageProfondeur(Screen):
     info = NumericProperty(0)
     mode_expo = NumericProperty(0)
     threshold_move = NumericProperty(0.8)
+    input_scale = NumericProperty(1)
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -218,6 +223,7 @@ class ReglageProfondeur(Screen):
         self.pile_size = self.lissage + 1
         self.mode_expo = int(self.app.config.get('grandeechelle', 'mode_expo'))
         self.threshold_move = float(self.app.config.get('move', 'threshold'))
+        self.input_scale = float(self.app.config.get('pose', 'input_scale'))
 
     def do_slider(self, iD, instance, value):
         """Méthode appelée si action sur un slider.
@@ -261,6 +267,15 @@ class ReglageProfondeur(Screen):
             if scr.p3_conn:
                 scr.p3_conn.send(['threshold', self.threshold_move])
 
+        if iD == 'input_scale':
+            self.input_scale = round(value, 2)
+
+            self.app.config.set('pose', 'input_scale', self.input_scale)
+            self.app.config.write()
+
+            if scr.p1_conn:
+                scr.p1_conn.send(['input_scale', self.input_scale])
+
         if iD == 'profondeur_mini':
             self.profondeur_mini = int(value)
 
@@ -414,11 +429,47 @@ class Grande_EchelleApp(App):
 
         config.setdefaults( 'camera',
                                         {   'width_input': 1280,
-                                            'height_input': 720})
+                                            'height_input': 720,
+                                            'depth_width': 1280,
+                                            'depth_height': 720,
+                                            'decimation': 1,
+                                            'replay': '',
+                                            'replay_speed': 1,
+                                            'record': '',
+                                            'capture_thread': 1,
+                                            'align': 1})
 
         config.setdefaults( 'pose',
                                         {   'threshold_pose': 0.15,
-                                            'threshold_points': 0.29})
+                                            'threshold_points': 0.29,
+                                            'depth_around': 1,
+                                            'depth_trim': 1,
+                                            'input_scale': 1.0,
+                                            'backend': 'torch',
+                                            'device': 'cuda',
+                                            'threads': 0,
+                                            'interop_threads': 0,
+                                            'adaptive': 0,
+                                            'levels': '101:1.0, 101:0.75, 75:0.75, 50:0.5',
+                                            'frame_budget': 50,
+                                            'decoder': 'numpy',
+                                            'max_candidates': 100,
+                                            'zone_filter': 1,
+                                            'zone_margin': 600,
+                                            'zone_depth': 2000,
+                                            'single': 0,
+                                            'single_radius': 32,
+                                            'skip': 0,
+                                            'skip_max': 4,
+                                            'skip_motion_low': 2,
+                                            'skip_motion_high': 10,
+                                            'skip_min_ratio': 0.6,
+                                            'crop': 0,
+                                            'crop_size': 384,
+                                            'crop_margin': 1.2,
+                                            'crop_full_delay': 0.25,
+                                            'cascade': 0,
+                                            'cascade_scale': 0.5})
 
         config.setdefaults( 'grandeechelle',
                                         {   'frame_rate_du_film': 25,
@@ -442,6 +493,22 @@ class Grande_EchelleApp(App):
                                          'size2000': 600,
                                          'size8000': 200})
 
+        config.setdefaults( 'presence',
+                                        {   'gate': 1,
+                                            'step': 8,
+                                            'min_pixels': 40,
+                                            'leave_delay': 3,
+                                            'idle_fps': 5})
+
+        config.setdefaults( 'tracker',
+                                        {   'tracking': 1,
+                                            'max_distance': 600,
+                                            'max_age': 0.5,
+                                            'hysteresis': 300,
+                                            'switch_frames': 15,
+                                            'keypoint_radius': 40,
+                                            'overlap_weight': 0.5})
+
         print("self.config peut maintenant être appelé")
 
     def go_mainscreen(self):
@@ -0,0 +1,123 @@
+
+"""
+Posenet une image sur N, les keypoints sont déplacés entre 2 calculs posenet
+par flot optique (Lucas-Kanade pyramidal) sur l'image couleur en niveaux de
+gris. La profondeur est relue dans chaque nouvelle image de profondeur.
+
+N s'adapte au mouvement: en pixels par image, mesuré sur les centres des
+squelettes,
+    mouvement <= motion_low  --> N = skip_max
+    mouvement >= motion_high --> N = 1, posenet à chaque image
+et entre les deux, linéaire.
+
+Posenet est aussi relancé dès que le flot perd plus de 1 - min_ratio des
+keypoints, ou qu'il n'y a plus personne à suivre.
+"""
+
+
+import numpy as np
+import cv2
+
+from skelets import Skelets
+
+
+class KeypointFlow:
+
+    def __init__(self, skip_max=4, motion_low=2, motion_high=10, min_ratio=0.6,
+                 win_size=21, max_level=3):
+
+        self.skip_max = skip_max
+        self.motion_low = motion_low
+        self.motion_high = motion_high
+        self.min_ratio = min_ratio
+        self.lk_params = dict(winSize=(win_size, win_size),
+                              maxLevel=max_level,
+                              criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT,
+                                        20, 0.03))
+
+        # Image précédente et squelettes qui y sont
+        self.gray = None
+        self.next_gray = None
+        self.skelets = None
+
+        # Images depuis le dernier calcul posenet, et N en cours
+        self.frames = 0
+        self.skip = 1
+        # Mouvement lissé en pixels par image
+        self.motion = 0
+        # Trop de keypoints perdus par le flot
+        self.lost = False
+
+        # Pour info, remis à 0 par l'affichage
+        self.inferences = 0
+        self.propagations = 0
+
+    def new_frame(self, img):
+        """Nouvelle image BGR, avant tout dessin dessus"""
+        self.next_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+    def need_inference(self):
+        """True si posenet doit tourner sur cette image"""
+
+        return not self.skelets or self.gray is None or self.lost or\
+               self.frames + 1 >= self.skip
+
+    def propagate(self):
+        """Les squelettes de l'image précédente déplacés dans la nouvelle,
+        les keypoints perdus par le flot ne sont plus valides
+        """
+        valid = self.skelets.valid
+        points = self.skelets.xys[valid].astype(np.float32).reshape(-1, 1, 2)
+        moved, status, _ = cv2.calcOpticalFlowPyrLK(self.gray, self.next_gray,
+                                                    points, None,
+                                                    **self.lk_params)
+        moved = moved.reshape(-1, 2)
+        height, width = self.next_gray.shape
+        ok = (status.ravel() == 1) &\
+             (moved[:, 0] >= 0) & (moved[:, 0] < width) &\
+             (moved[:, 1] >= 0) & (moved[:, 1] < height)
+
+        xys = self.skelets.xys.copy()
+        xys[valid] = np.rint(moved).astype(np.int64)
+        new_valid = valid.copy()
+        new_valid[valid] = ok
+        self.lost = np.count_nonzero(ok) < self.min_ratio*len(ok)
+
+        skelets = Skelets(xys, self.skelets.scores, new_valid)
+        return skelets.subset(new_valid.any(axis=1))
+
+    def update(self, skelets, inference):
+        """Squelettes retenus dans cette image, inference = True si calculés
+        par posenet, False si propagés
+        """
+        if self.skelets and skelets:
+            self.update_motion(skelets)
+
+        if inference:
+            self.frames = 0
+            self.inferences += 1
+            self.lost = False
+        else:
+            self.frames += 1
+            self.propagations += 1
+
+        self.skelets = skelets if skelets else None
+        self.gray = self.next_gray
+
+    def update_motion(self, skelets):
+        """Déplacement de chaque centre depuis le plus proche de l'image
+        précédente, médiane lissée, puis N
+        """
+        previous = self.skelets.centers_2D()
+        centers = skelets.centers_2D()
+        gaps = np.linalg.norm(centers[:, np.newaxis] - previous[np.newaxis],
+                              axis=-1)
+        gaps = np.min(gaps, axis=1)
+        gaps = gaps[~np.isnan(gaps)]
+        if not len(gaps):
+            return
+
+        self.motion = 0.5*self.motion + 0.5*np.median(gaps)
+        skip = np.interp(self.motion, [self.motion_low, self.motion_high],
+                         [self.skip_max, 1])
+        self.skip = int(round(skip))
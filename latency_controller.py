@@ -0,0 +1,97 @@
+
+"""
+Choix du model Posenet et de l'échelle d'entrée selon le temps de calcul
+
+Les niveaux vont du plus précis au plus rapide, par exemple:
+    101:1.0, 101:0.75, 75:0.75, 50:0.5
+soit MobileNetV1 101 sur l'image entière, puis réduite à 0.75, puis
+MobileNetV1 75, ...
+
+Le temps de calcul de chaque image est mesuré. Sur une fenêtre de window
+images, si la moyenne dépasse le budget de plus de margin, on passe au niveau
+plus rapide. Si elle est en dessous du budget de plus de margin pendant
+patience fenêtres de suite, on remonte au niveau plus précis.
+La descente est rapide, la remontée lente: pas de va et vient. A chaque
+descente depuis un niveau, la patience pour y remonter est doublée, jusqu'à
+ce que ce niveau tienne à nouveau le budget.
+"""
+
+
+from collections import deque
+
+import numpy as np
+
+
+def parse_levels(levels):
+    """'101:1.0, 75:0.75' --> [(101, 1.0), (75, 0.75)]"""
+
+    parsed = []
+    for level in levels.split(','):
+        model_id, scale = level.strip().split(':')
+        parsed.append((int(model_id), float(scale)))
+    return parsed
+
+
+class LatencyController:
+
+    def __init__(self, levels, budget, window=30, margin=0.15, patience=3):
+        """levels = liste de (model_id, scale), du plus précis au plus rapide
+        budget = temps de calcul visé par image en s
+        """
+        self.levels = levels
+        self.budget = budget
+        self.window = window
+        self.margin = margin
+        self.patience = patience
+
+        self.level = 0
+        self.latencies = deque(maxlen=window)
+        self.good_windows = 0
+        # Nombre de bonnes fenêtres pour remonter à chaque niveau
+        self.up_patience = [patience]*len(levels)
+        # Dernière moyenne mesurée à chaque niveau, pour info
+        self.measured = [None]*len(levels)
+
+    @property
+    def current(self):
+        """(model_id, scale) du niveau en cours"""
+        return self.levels[self.level]
+
+    def set_level(self, level):
+        self.level = level
+        self.latencies.clear()
+        self.good_windows = 0
+        model_id, scale = self.current
+        print(f"Posenet: passage au model {model_id}, échelle {scale}")
+
+    def update(self, latency):
+        """Ajoute le temps de calcul d'une image en s,
+        retourne True si le niveau a changé
+        """
+        self.latencies.append(latency)
+        if len(self.latencies) < self.window:
+            return False
+
+        moyenne = np.mean(self.latencies)
+        self.measured[self.level] = moyenne
+        self.latencies.clear()
+
+        if moyenne > self.budget*(1 + self.margin):
+            self.good_windows = 0
+            if self.level < len(self.levels) - 1:
+                self.up_patience[self.level] = min(2*self.up_patience[self.level],
+                                                   32*self.patience)
+                self.set_level(self.level + 1)
+                return True
+
+        elif moyenne < self.budget*(1 - self.margin):
+            self.good_windows += 1
+            self.up_patience[self.level] = self.patience
+            if self.level > 0 and \
+                    self.good_windows >= self.up_patience[self.level - 1]:
+                self.set_level(self.level - 1)
+                return True
+        else:
+            self.good_windows = 0
+
+        return False
@@ -34,63 +34,359 @@ from time import time
 import numpy as np
 
 import posenet
+from posenet_backends import get_backend
+from latency_controller import LatencyController, parse_levels
+from skelets import Skelets
 
 
-class MyPosenetPytorch:
+class PosenetInput:
+    """Conversion des images BGR en tenseur (1, 3, 721, 1281) pour posenet,
+    sans allocation à chaque image.
 
-    def __init__(self, model_dir):
+    Le tenseur est alloué une fois pour toutes. L'image 1280x720 est écrite
+    dedans en RGB normalisé entre -1 et 1, la bande de 1 pixel en bas et à
+    droite demandée par le model reste noire, soit -1.
 
-        self.model = posenet.load_model(101, model_dir=model_dir)
-        self.model = self.model.cuda()
-        self.output_stride = self.model.output_stride
-        self.scale_factor = 1
+    Avec scale < 1, l'image est d'abord réduite à une résolution valide pour
+    output_stride, par exemple 641x353 avec 0.5, et self.scale permet de
+    revenir aux coordonnées de l'image 1280x720.
+
+    Avec batch > 1, le tenseur (batch, 3, h, w) reçoit plusieurs images,
+    voir process_batch().
+    """
+
+    def __init__(self, width, height, output_stride=16, device='cuda',
+                 scale=1, batch=1):
+
+        self.width = width
+        self.height = height
+        self.scale_factor = scale
+        self.batch = batch
+        target_width, target_height = posenet.valid_resolution(width*scale,
+                                                               height*scale,
+                                                               output_stride)
+        # Taille de l'image dans le tenseur, sans la bande noire
+        self.input_width = target_width - 1
+        self.input_height = target_height - 1
+        # Pour revenir aux coordonnées y, x de l'image d'origine
+        self.scale = np.array([height / self.input_height,
+                               width / self.input_width])
+
+        # Image réduite, allouée une fois
+        self.resized = None
+        if (self.input_width, self.input_height) != (width, height):
+            self.resized = np.empty((self.input_height, self.input_width, 3),
+                                    dtype=np.uint8)
+
+        shape = (batch, 3, target_height, target_width)
+
+        self.host_tensor = torch.full(shape, -1.0, dtype=torch.float32)
+        if device == 'cpu':
+            self.tensor = self.host_tensor
+        else:
+            # Copie asynchrone vers le GPU depuis de la mémoire non paginée
+            self.host_tensor = self.host_tensor.pin_memory()
+            self.tensor = torch.full(shape, -1.0, dtype=torch.float32,
+                                     device=device)
+
+        # La partie des images, sans la bande noire
+        self.rgb = self.host_tensor[:, :, :self.input_height, :self.input_width]
+
+    def write(self, img, index=0):
+        """Ecrit l'image BGR uint8 dans le tenseur, à la place index"""
+
+        if img.shape[:2] != (self.input_height, self.input_width):
+            if self.resized is None:
+                self.resized = np.empty((self.input_height, self.input_width, 3),
+                                        dtype=np.uint8)
+            cv2.resize(img, (self.input_width, self.input_height),
+                       dst=self.resized, interpolation=cv2.INTER_LINEAR)
+            img = self.resized
+
+        bgr = torch.from_numpy(img)
+        rgb = self.rgb[index]
+        # BGR --> RGB en float32, canal par canal
+        for c in range(3):
+            rgb[c].copy_(bgr[:, :, 2 - c])
+        rgb.mul_(2.0 / 255.0).sub_(1.0)
+
+    def process(self, img):
+        """img = array (720, 1280, 3) BGR uint8
+        Retourne le tenseur prêt pour le model
+        """
+        self.write(img)
+
+        if self.tensor is not self.host_tensor:
+            self.tensor.copy_(self.host_tensor, non_blocking=True)
+
+        return self.tensor
+
+    def process_batch(self, imgs):
+        """imgs = liste de batch images BGR uint8 maxi, de tailles quelconques,
+        chacune réduite à la taille d'entrée: images entières ou découpes.
+        Retourne le tenseur (len(imgs), 3, h, w), et pour chaque image le
+        facteur y, x pour revenir à ses coordonnées
+        """
+        scales = []
+        for i, img in enumerate(imgs):
+            self.write(img, i)
+            scales.append(np.array([img.shape[0] / self.input_height,
+                                    img.shape[1] / self.input_width]))
+
+        n = len(imgs)
+        if self.tensor is not self.host_tensor:
+            self.tensor[:n].copy_(self.host_tensor[:n], non_blocking=True)
+
+        return self.tensor[:n], scales
+
+
+class MyPosenetPytorch:
 
-    def compute_image(self, img_in, threshold_pose, threshold_points):
+    def __init__(self, model_dir, config):
+        """config = dict de config, sections camera et pose"""
+
+        self.width = int(config['camera']['width_input'])
+        self.height = int(config['camera']['height_input'])
+        # Réduction de l'image avant posenet, modifiable en cours de route
+        self.scale_factor = float(config['pose']['input_scale'])
+        # Décodage des squelettes: numpy sur le CPU, ou torch sur le device
+        self.decoder = config['pose']['decoder']
+        # Nombre maxi de racines candidates au décodage, 0 pour toutes
+        self.max_candidates = int(config['pose']['max_candidates']) or None
+        # Zone d'interaction: colonnes (x mini, x maxi) de l'image où peut se
+        # trouver une racine, et filtre des racines f(array (N, 2) des y, x)
+        self.zone_columns = None
+        self.root_filter = None
+        # Une seule personne: seul le squelette proche de la cible est décodé,
+        # cible = (array (17, 2) des y, x dans l'image, array (17,) bool) ou None
+        self.single = int(config['pose']['single'])
+        self.single_radius = float(config['pose']['single_radius'])
+        self.single_target = None
+        # Nombre d'images en mode une personne, et de retours au décodage complet
+        self.single_frames = 0
+        self.single_fallbacks = 0
+
+        # Mode adaptatif: model et échelle choisis selon le temps de calcul
+        self.controller = None
+        if int(config['pose']['adaptive']):
+            levels = parse_levels(config['pose']['levels'])
+            budget = float(config['pose']['frame_budget'])/1000
+            self.controller = LatencyController(levels, budget)
+            model_ids = [model_id for model_id, scale in levels]
+        else:
+            model_ids = [101]
+
+        # Un backend par model, tous chargés au lancement
+        # Model sur GPU ou CPU selon [pose] device
+        self.backends = {}
+        for model_id in model_ids:
+            if model_id not in self.backends:
+                self.backends[model_id] = get_backend(model_dir, config, model_id)
+        self.backend = self.backends[model_ids[0]]
+        self.output_stride = self.backend.output_stride
+
+        # Un PosenetInput par échelle, alloué une fois
+        self.posenet_inputs = {}
+        # Ceux de compute_images par taille d'entrée et échelle,
+        # réalloués si le batch grandit
+        self.batch_inputs = {}
+        if self.controller:
+            self.warm_up()
+            self.set_level()
+        self.posenet_input = self.get_posenet_input(self.scale_factor)
+
+    def get_posenet_input(self, scale):
+        if scale not in self.posenet_inputs:
+            self.posenet_inputs[scale] = PosenetInput(self.width, self.height,
+                                                      self.output_stride,
+                                                      self.backend.device,
+                                                      scale)
+        return self.posenet_inputs[scale]
+
+    def warm_up(self):
+        """Un 1er calcul à chaque niveau: allocations, compilation,
+        choix des algos cudnn, pour que les changements de niveau soient
+        immédiats
+        """
+        img = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+        for model_id, scale in self.controller.levels:
+            print(f"Préchauffage du model {model_id} à l'échelle {scale}")
+            tensor = self.get_posenet_input(scale).process(img)
+            with torch.inference_mode():
+                self.backends[model_id](tensor)
+
+    def set_level(self):
+        """Model et échelle du niveau en cours du controller"""
+        model_id, self.scale_factor = self.controller.current
+        self.backend = self.backends[model_id]
+
+    def compute_image(self, img_in, threshold_pose, threshold_points,
+                      scale_factor=None):
         """A partir d'une image 1280x720 BGR, trouve maxi 4 squelettes.
-        Retourne une liste des xys = all_xys
-        Un xy = liste de 17 points (valide ou None) ou None si rien du tout.
+        scale_factor = réduction de l'image, par défaut self.scale_factor
+        Retourne les Skelets, voir skelets.py
         """
 
-        # img_in = image 1281x721 et arrangée pour posenet
-        img_in = my_process_input(img_in)
+        t = time()
 
-        with torch.no_grad():
-            # Chargement du array sur le GPU, puis calcul sur le GPU
-            img_in = torch.Tensor(img_in).cuda()
+        # Nouvelle échelle reçue du GUI, ou du controller
+        scale_factor = scale_factor or self.scale_factor
+        if scale_factor != self.posenet_input.scale_factor:
+            self.posenet_input = self.get_posenet_input(scale_factor)
 
-            heatmaps_result, offsets_result,\
-            displacement_fwd_result, displacement_bwd_result = self.model(img_in)
+        with torch.inference_mode():
+            # img_in = tenseur 1281x721 arrangé pour posenet, sur le device
+            img_in = self.posenet_input.process(img_in)
+            outputs = self.backend(img_in)
 
-            a = posenet.decode_multiple_poses(heatmaps_result.squeeze(0),
-                                              offsets_result.squeeze(0),
-                                              displacement_fwd_result.squeeze(0),
-                                              displacement_bwd_result.squeeze(0),
-                                              output_stride=self.output_stride,
-                                              max_pose_detections=4,
-                                              min_pose_score=threshold_pose)
+            # Coordonnées dans l'image 1280x720
+            skelets = self.decode_outputs(outputs, 0, self.posenet_input.scale,
+                                          threshold_pose, threshold_points,
+                                          zone=True)
 
-            pose_scores, keypoint_scores, keypoint_coords = a
+        if self.controller and self.controller.update(time() - t):
+            self.set_level()
 
+        return skelets
+
+    def compute_images(self, imgs, threshold_pose, threshold_points,
+                       input_size=None, max_pose_detections=4):
+        """Plusieurs images BGR, ou découpes d'une image, en un seul passage
+        dans le model.
+        input_size = (largeur, hauteur) de référence, réduite par
+                     self.scale_factor, toutes les images y sont ramenées.
+                     Par défaut, la taille de la caméra.
+        Retourne pour chaque image ses Skelets, en coordonnées de l'image
+        """
+        if not len(imgs):
+            return []
+
+        width, height = input_size or (self.width, self.height)
+        key = (width, height, self.scale_factor)
+        batch_input = self.batch_inputs.get(key)
+        if batch_input is None or batch_input.batch < len(imgs):
+            batch_input = PosenetInput(width, height, self.output_stride,
+                                       self.backend.device, self.scale_factor,
+                                       batch=len(imgs))
+            self.batch_inputs[key] = batch_input
+
+        with torch.inference_mode():
+            tensor, scales = batch_input.process_batch(imgs)
+            outputs = self.backend(tensor)
+
+            skelets_list = []
+            for index, scale in enumerate(scales):
+                skelets_list.append(self.decode_outputs(outputs, index, scale,
+                                                        threshold_pose,
+                                                        threshold_points,
+                                                        max_pose_detections))
+
+        return skelets_list
+
+    def get_column_mask(self, heatmap_width, scale):
+        """Colonnes de la heatmap dans self.zone_columns, à une cellule près"""
+
+        if self.zone_columns is None:
+            return None
+        x_min, x_max = self.zone_columns
+        cell = self.output_stride*scale[1]
+        x = np.arange(heatmap_width)*cell
+        return (x >= x_min - cell) & (x <= x_max + cell)
+
+    def decode_outputs(self, outputs, index, scale, threshold_pose,
+                       threshold_points, max_pose_detections=4, zone=False):
+        """Décode les squelettes de l'image index du batch des sorties
+        du model, scale = facteur y, x vers les coordonnées de l'image
+        Retourne les Skelets de l'image
+        zone = True pour ne décoder que les racines dans la zone d'interaction,
+               pour une image entière seulement
+        """
+        heatmaps_result, offsets_result,\
+        displacement_fwd_result, displacement_bwd_result = outputs
+
+        column_mask, root_filter = None, None
+        if zone:
+            column_mask = self.get_column_mask(heatmaps_result.shape[-1], scale)
+            if self.root_filter:
+                def root_filter(root_ids, root_image_coords):
+                    return self.root_filter(root_image_coords*scale)
+
+        a = None
+        if zone and self.single:
+            self.single_frames += 1
+            if self.single_target is not None:
+                target_coords, target_valid = self.single_target
+                # Avec decoder = torch, la racine est choisie et décodée
+                # sur le device, seul le squelette revient sur l'hôte
+                if self.decoder == 'torch':
+                    decode_near = posenet.decode_single_pose_near_torch
+                else:
+                    decode_near = posenet.decode_single_pose_near
+                a = decode_near(heatmaps_result[index],
+                                offsets_result[index],
+                                displacement_fwd_result[index],
+                                displacement_bwd_result[index],
+                                output_stride=self.output_stride,
+                                target_coords=target_coords/scale,
+                                target_valid=target_valid,
+                                search_radius=self.single_radius,
+                                min_pose_score=threshold_pose,
+                                max_candidates=self.max_candidates,
+                                column_mask=column_mask,
+                                root_filter=root_filter)
+            if a is None:
+                # Cible perdue, décodage de tous les squelettes
+                self.single_fallbacks += 1
+
+        if a is not None:
+            pose_scores, keypoint_scores, keypoint_coords = a
+        elif self.decoder == 'torch':
+            # Décodage sur le device, seuls les squelettes reviennent sur l'hôte
+            pose_scores, poses = posenet.decode_multiple_poses_torch(
+                                        heatmaps_result[index],
+                                        offsets_result[index],
+                                        displacement_fwd_result[index],
+                                        displacement_bwd_result[index],
+                                        output_stride=self.output_stride,
+                                        max_pose_detections=max_pose_detections,
+                                        min_pose_score=threshold_pose,
+                                        max_candidates=self.max_candidates,
+                                        column_mask=column_mask,
+                                        root_filter=root_filter)
+            keypoint_scores, keypoint_coords = poses[:, :, 2], poses[:, :, :2]
+        else:
+            a = posenet.decode_multiple_poses_vectorized(heatmaps_result[index],
+                                                         offsets_result[index],
+                                                         displacement_fwd_result[index],
+                                                         displacement_bwd_result[index],
+                                                         output_stride=self.output_stride,
+                                                         max_pose_detections=max_pose_detections,
+                                                         min_pose_score=threshold_pose,
+                                                         max_candidates=self.max_candidates,
+                                                         column_mask=column_mask,
+                                                         root_filter=root_filter)
+            pose_scores, keypoint_scores, keypoint_coords = a
 
-        all_xys = []
-        for i in range(len(pose_scores)):
-            xys_list = keypoint_coords_to_xys_list( keypoint_scores[i],
-                                                    keypoint_coords[i],
-                                                    threshold_points)
-            if xys_list:
-                all_xys.append(xys_list)
+        keypoint_coords *= scale
 
-        return all_xys
+        return Skelets.from_keypoints(keypoint_scores, keypoint_coords,
+                                      threshold_points)
 
 
 class MyPosenetPytorchCamTest:
 
     def __init__(self, dev):
 
-        self.model = posenet.load_model(101)
-        self.model = self.model.cuda()
-        self.output_stride = self.model.output_stride
+        config = {'pose': { 'backend': 'torch',
+                            'device': 'auto',
+                            'threads': 0,
+                            'interop_threads': 0}}
+        self.backend = get_backend(posenet.models.model_factory.MODEL_DIR,
+                                   config)
+        self.output_stride = self.backend.output_stride
         self.scale_factor = 1
+        self.posenet_input = PosenetInput(1280, 720, self.output_stride,
+                                          self.backend.device)
         self.cap = cv2.VideoCapture(dev)
         self.cap.set(3, 1280)
         self.cap.set(4, 720)
@@ -103,26 +399,23 @@ class MyPosenetPytorchCamTest:
 
             res, img = self.cap.read()
 
-            # img_in = image 1281x721 et arrangée pour posenet
-            if res:
-                img_in = my_process_input(img)
-            else:
+            if not res:
                 break
 
-            with torch.no_grad():
-                # Chargement du array sur le GPU, puis calcul sur le GPU
-                img_in = torch.Tensor(img_in).cuda()
+            with torch.inference_mode():
+                # img_in = tenseur 1281x721 arrangé pour posenet, sur le device
+                img_in = self.posenet_input.process(img)
 
                 heatmaps_result, offsets_result,\
-                displacement_fwd_result, displacement_bwd_result = self.model(img_in)
+                displacement_fwd_result, displacement_bwd_result = self.backend(img_in)
 
-                a = posenet.decode_multiple_poses(heatmaps_result.squeeze(0),
-                                                  offsets_result.squeeze(0),
-                                                  displacement_fwd_result.squeeze(0),
-                                                  displacement_bwd_result.squeeze(0),
-                                                  output_stride=self.output_stride,
-                                                  max_pose_detections=1,
-                                                  min_pose_score=0.15)
+                a = posenet.decode_multiple_poses_vectorized(heatmaps_result.squeeze(0),
+                                                             offsets_result.squeeze(0),
+                                                             displacement_fwd_result.squeeze(0),
+                                                             displacement_bwd_result.squeeze(0),
+                                                             output_stride=self.output_stride,
+                                                             max_pose_detections=1,
+                                                             min_pose_score=0.15)
 
                 pose_scores, keypoint_scores, keypoint_coords = a
 
@@ -144,28 +437,6 @@ class MyPosenetPytorchCamTest:
 
 
 
-def my_process_input(source_img):
-    """Conversion d'une image en array  (1, 3, 721, 1281)
-    L'image d'entrée est 1280x720
-    Le model demande une image 1281x721
-    Je rajoute une bande noire de 1 pixels en bas et à droite
-
-    source_img.shape = (720, 1280, 3)
-    """
-
-    row = np.zeros((1, 1280, 3), np.uint8)
-    input_img = np.vstack((source_img, row))
-
-    column = np.zeros((720, 1, 3), np.uint8)
-    input_img = np.hstack((source_img, column))
-
-    input_img = cv2.cvtColor(input_img, cv2.COLOR_BGR2RGB).astype(np.float32)
-    input_img = input_img * (2.0 / 255.0) - 1.0
-    input_img = input_img.transpose((2, 0, 1)).reshape(1, 3, 720, 1281)
-
-    return input_img
-
-
 def keypoint_coords_to_xys_list(keypoint_scores, keypoint_coords, score_mini):
     """
     pose_scores = 0.1808 > 0.15
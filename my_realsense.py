@@ -2,11 +2,18 @@
 ## Copyright(c) 2017 Intel Corporation. All Rights Reserved.
 
 import os
-from time import sleep
+from time import time, sleep
 
 import numpy as np
 
-import pyrealsense2 as rs
+try:
+    import pyrealsense2 as rs
+except ImportError:
+    rs = None
+
+from my_replay import ReplayPipeline, ReplayAlign, SessionRecorder,\
+                      dict_to_intrinsics
+from capture_thread import FrameMailbox, CaptureThread
 
 
 class MyRealSense:
@@ -17,8 +24,46 @@ class MyRealSense:
         self.config = kwargs
         self.width = int(self.config['camera']['width_input'])
         self.height = int(self.config['camera']['height_input'])
+        # Flux de profondeur, indépendant de la couleur, et décimation
+        self.depth_width = int(self.config['camera']['depth_width'])
+        self.depth_height = int(self.config['camera']['depth_height'])
+        self.decimation = int(self.config['camera']['decimation'])
+        self.decimation_filter = None
         self.device = None
-        self.set_pipeline()
+        # Profondeur en m = valeur z16 * depth_scale
+        self.depth_scale = 0.001
+
+        # Relecture d'une session enregistrée à la place de la caméra
+        self.replay = self.config['camera']['replay']
+        self.replay_speed = float(self.config['camera']['replay_speed'])
+        # Enregistrement de la session dans ce dossier
+        self.record = self.config['camera']['record']
+        self.recorder = None
+
+        # 1 alignement de toute l'image de profondeur avec rs.align,
+        # 0 alignement des seuls keypoints, voir sparse_align.py
+        self.align_frames = int(self.config['camera']['align'])
+
+        # Capture dans un thread, Posenet prend toujours la plus récente
+        self.capture_thread = int(self.config['camera']['capture_thread'])
+        self.mailbox = None
+        self.capture = None
+        # Veille: seule la profondeur brute est lue, voir set_raw_frames()
+        self.raw_frames = False
+
+        if self.replay:
+            self.set_replay_pipeline()
+        else:
+            self.set_pipeline()
+
+        if self.record and not self.align_frames:
+            print("L'enregistrement d'une session demande align = 1")
+        elif self.record:
+            self.recorder = SessionRecorder(self.record,
+                                            self.width,
+                                            self.height,
+                                            self.depth_intrinsic,
+                                            self.depth_scale)
 
     def set_pipeline(self):
         """
@@ -28,6 +73,10 @@ class MyRealSense:
         """
         print(f"Pipeline RealSense lancé ...")
 
+        if rs is None:
+            print('\n\npyrealsense2 n\'est pas installé\n\n')
+            os._exit(0)
+
         self.pipeline = rs.pipeline()
         config = rs.config()
         pipeline_wrapper = rs.pipeline_wrapper(self.pipeline)
@@ -48,23 +97,137 @@ class MyRealSense:
                                 framerate=30)
 
         config.enable_stream(   rs.stream.depth,
-                                width=self.width,
-                                height=self.height,
+                                width=self.depth_width,
+                                height=self.depth_height,
                                 format=rs.format.z16,
                                 framerate=30)
 
-        self.pipeline.start(config)
+        profile = self.pipeline.start(config)
+        depth_sensor = profile.get_device().first_depth_sensor()
+        self.depth_scale = depth_sensor.get_depth_scale()
         # # sleep(1)
-        self.align = rs.align(rs.stream.color)
+        if self.align_frames:
+            self.align = rs.align(rs.stream.color)
+        else:
+            self.align = None
         # # sleep(1)
         unaligned_frames = self.pipeline.wait_for_frames()
+        if self.decimation > 1:
+            self.decimation_filter = rs.decimation_filter()
+            self.decimation_filter.set_option(rs.option.filter_magnitude,
+                                              self.decimation)
         # # sleep(1)
-        frames = self.align.process(unaligned_frames)
+        # Les intrinsics sont celles de la profondeur décimée et/ou alignée
+        # La profondeur lue en veille, sans décimation ni alignement
+        raw_profile = unaligned_frames.get_depth_frame().profile
+        self.depth_idle_intrinsic = raw_profile.as_video_stream_profile().intrinsics
+        frames = self.process_frames(unaligned_frames)
         depth = frames.get_depth_frame()
-        self.depth_intrinsic = depth.profile.as_video_stream_profile().intrinsics
+        depth_profile = depth.profile.as_video_stream_profile()
+        self.depth_intrinsic = depth_profile.intrinsics
 
         # Affichage de la taille des images
         color_frame = frames.get_color_frame()
+
+        if not self.align:
+            # Seuls les keypoints seront alignés, avec les intrinsics et les
+            # extrinsics des 2 capteurs
+            color_profile = color_frame.profile.as_video_stream_profile()
+            self.depth_raw_intrinsic = self.depth_intrinsic
+            # Les keypoints sont dans l'image couleur, comme après rs.align
+            self.depth_intrinsic = color_profile.intrinsics
+            self.color_to_depth = color_profile.get_extrinsics_to(depth_profile)
+            self.depth_to_color = depth_profile.get_extrinsics_to(color_profile)
+
         img = np.asanyarray(color_frame.get_data())
         print(f"Taille des images:"
               f"     {img.shape[1]}x{img.shape[0]}")
+        print(f"Taille des images de profondeur:"
+              f"     {depth.get_width()}x{depth.get_height()}")
+
+    def start_capture(self):
+        """Lance le thread de capture si demandé dans la config"""
+
+        if self.capture_thread:
+            self.mailbox = FrameMailbox()
+            self.capture = CaptureThread(self.pipeline,
+                                         self.process_frames,
+                                         self.mailbox)
+            self.capture.start()
+
+    def process_frames(self, frames):
+        """Décimation de la profondeur, puis alignement sur la couleur"""
+
+        if self.decimation_filter:
+            frames = self.decimation_filter.process(frames).as_frameset()
+
+        # Align the depth frame to color frame
+        if self.align:
+            frames = self.align.process(frames)
+
+        return frames
+
+    def set_raw_frames(self, raw):
+        """raw = True pour la veille: ni décimation ni alignement, seule la
+        profondeur brute est lue, get_frames() retourne None pour la couleur.
+        La caméra reste à 30 fps: pyrealsense2 ne change la fréquence
+        qu'en relançant le pipeline.
+        """
+        self.raw_frames = raw
+        if self.capture:
+            self.capture.raw = raw
+
+    def get_frames(self):
+        """Retourne les arrays couleur et profondeur, alignée si align, et le
+        time() de la capture, ou None, None, None si pas de capture
+        En veille, la couleur est None et la profondeur brute.
+        """
+        if self.capture:
+            return self.mailbox.get()
+
+        frames = self.pipeline.wait_for_frames(timeout_ms=80)
+        t = time()
+
+        if self.raw_frames:
+            depth = frames.get_depth_frame()
+            if not depth:
+                return None, None, None
+            return None, np.asanyarray(depth.as_frame().get_data()), t
+
+        aligned_frames = self.process_frames(frames)
+
+        color = aligned_frames.get_color_frame()
+        depth = aligned_frames.get_depth_frame()
+        if not color or not depth:
+            return None, None, None
+
+        return (np.asanyarray(color.as_frame().get_data()),
+                np.asanyarray(depth.as_frame().get_data()),
+                t)
+
+    def stop_pipeline(self):
+        """Arrêt du thread de capture avant celui de la caméra"""
+
+        if self.capture:
+            self.capture.stop()
+        self.pipeline.stop()
+
+    def set_replay_pipeline(self):
+        """Relecture de la session self.replay, avec la même interface que
+        la caméra: self.pipeline, self.align, self.depth_intrinsic
+        """
+        print(f"Relecture de la session {self.replay} ...")
+
+        if not self.align_frames:
+            print("Les sessions enregistrées sont déjà alignées")
+            self.align_frames = 1
+
+        self.pipeline = ReplayPipeline(self.replay, self.replay_speed)
+        self.align = ReplayAlign()
+        self.width = self.pipeline.width
+        self.height = self.pipeline.height
+        self.depth_scale = self.pipeline.depth_scale
+        self.depth_intrinsic = dict_to_intrinsics(
+                                        self.pipeline.infos['depth_intrinsic'])
+        # La profondeur enregistrée est déjà alignée, en veille aussi
+        self.depth_idle_intrinsic = self.depth_intrinsic
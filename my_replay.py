@@ -0,0 +1,294 @@
+
+"""
+Enregistrement et relecture d'une session RealSense
+
+Une session est un dossier qui contient:
+    color.raw       les images couleur bgr8 alignées, les unes à la suite
+    depth.raw       les images de profondeur z16 alignées, idem
+    timestamps.raw  le time() de chaque capture en float64
+    session.json    taille des images, depth_scale, intrinsics de la profondeur
+
+La relecture lit les images avec des np.memmap, et imite ce que
+PosenetRealsense.run() utilise de pyrealsense2:
+    pipeline.wait_for_frames(), align.process(),
+    depth_frame.get_distance(u, v), depth_intrinsic
+
+Permet de faire tourner Posenet --> 3D --> zoom --> OSC sans caméra.
+
+Enregistrement d'une session de 300 images avec la caméra branchée:
+    python3 my_replay.py /le/dossier/de/la/session 300
+"""
+
+
+import os
+import sys
+import json
+from time import time, sleep
+
+import numpy as np
+
+try:
+    import pyrealsense2 as rs
+except ImportError:
+    rs = None
+
+
+class SessionRecorder:
+    """Enregistre des images alignées couleur et profondeur dans une session"""
+
+    def __init__(self, session_dir, width, height, depth_intrinsic,
+                 depth_scale=0.001):
+
+        self.session_dir = session_dir
+        if not os.path.exists(self.session_dir):
+            os.makedirs(self.session_dir)
+
+        self.nbr = 0
+
+        # Le json est écrit tout de suite, seul nbr est mis à jour à la fin
+        self.infos = {  'width': width,
+                        'height': height,
+                        'depth_scale': depth_scale,
+                        'depth_intrinsic': intrinsics_to_dict(depth_intrinsic),
+                        'nbr': 0}
+        self.write_infos()
+
+        # Ajout à la suite, pour ne rien perdre si le script est tué
+        self.color_file = open(os.path.join(session_dir, 'color.raw'), 'wb')
+        self.depth_file = open(os.path.join(session_dir, 'depth.raw'), 'wb')
+        self.time_file = open(os.path.join(session_dir, 'timestamps.raw'), 'wb')
+
+        print(f"Enregistrement de la session dans {self.session_dir}")
+
+    def write_infos(self):
+        with open(os.path.join(self.session_dir, 'session.json'), 'w') as f:
+            json.dump(self.infos, f, indent=4)
+
+    def add(self, color, depth):
+        """color = array (h, w, 3) uint8, depth = array (h, w) uint16"""
+
+        self.color_file.write(np.ascontiguousarray(color, dtype=np.uint8).tobytes())
+        self.depth_file.write(np.ascontiguousarray(depth, dtype=np.uint16).tobytes())
+        self.time_file.write(np.float64(time()).tobytes())
+        self.nbr += 1
+
+    def close(self):
+        self.color_file.close()
+        self.depth_file.close()
+        self.time_file.close()
+        self.infos['nbr'] = self.nbr
+        self.write_infos()
+        print(f"Session enregistrée: {self.nbr} images")
+
+
+class ReplayIntrinsics:
+    """Les intrinsics enregistrées, avec les mêmes attributs que
+    rs.intrinsics
+    """
+
+    def __init__(self, d):
+
+        self.width = d['width']
+        self.height = d['height']
+        self.ppx = d['ppx']
+        self.ppy = d['ppy']
+        self.fx = d['fx']
+        self.fy = d['fy']
+        self.model = d['model']
+        self.coeffs = d['coeffs']
+
+
+class ReplayFrame:
+    """Une image relue, couleur ou profondeur"""
+
+    def __init__(self, data, depth_scale=None):
+
+        self.data = data
+        self.depth_scale = depth_scale
+        self.width = data.shape[1]
+        self.height = data.shape[0]
+
+    def __bool__(self):
+        return True
+
+    def as_frame(self):
+        return self
+
+    def get_data(self):
+        return self.data
+
+    def get_width(self):
+        return self.width
+
+    def get_height(self):
+        return self.height
+
+    def get_distance(self, u, v):
+        """Profondeur en m du pixel (u, v), comme rs.depth_frame"""
+        return float(self.data[v, u])*self.depth_scale
+
+
+class ReplayFrames:
+    """Les 2 images d'une capture, comme rs.composite_frame"""
+
+    def __init__(self, color_frame, depth_frame):
+
+        self.color_frame = color_frame
+        self.depth_frame = depth_frame
+
+    def get_color_frame(self):
+        return self.color_frame
+
+    def get_depth_frame(self):
+        return self.depth_frame
+
+
+class ReplayAlign:
+    """Les images enregistrées sont déjà alignées"""
+
+    def process(self, frames):
+        return frames
+
+
+class ReplayPipeline:
+    """Relit une session en boucle, comme rs.pipeline
+
+    speed = 1 vitesse de l'enregistrement, 2 deux fois plus vite, ...
+    speed = 0 aussi vite que possible, pour les benchmarks
+    """
+
+    def __init__(self, session_dir, speed=1):
+
+        self.speed = speed
+
+        with open(os.path.join(session_dir, 'session.json')) as f:
+            self.infos = json.load(f)
+
+        self.width = self.infos['width']
+        self.height = self.infos['height']
+        self.depth_scale = self.infos['depth_scale']
+
+        # Le nombre d'images est déduit de la taille du fichier, si la
+        # session n'a pas été fermée proprement, nbr du json vaut 0
+        timestamps = np.fromfile(os.path.join(session_dir, 'timestamps.raw'),
+                                 dtype=np.float64)
+        self.nbr = len(timestamps)
+        if not self.nbr:
+            raise RuntimeError(f"La session {session_dir} est vide")
+        self.timestamps = timestamps - timestamps[0]
+
+        # En lecture seule: avec mode='c', chaque image dessinée garderait
+        # ses pages copiées, et la mémoire grandirait jusqu'à la taille de
+        # la session. La couleur est copiée à chaque capture, voir
+        # wait_for_frames()
+        self.color = np.memmap(os.path.join(session_dir, 'color.raw'),
+                               dtype=np.uint8, mode='r',
+                               shape=(self.nbr, self.height, self.width, 3))
+        self.depth = np.memmap(os.path.join(session_dir, 'depth.raw'),
+                               dtype=np.uint16, mode='r',
+                               shape=(self.nbr, self.height, self.width))
+
+        self.index = 0
+        self.t_start = None
+
+        print(f"Relecture de {session_dir}: {self.nbr} images "
+              f"{self.width}x{self.height}")
+
+    def wait_for_frames(self, timeout_ms=5000):
+        """Retourne la capture suivante, en attendant son heure si speed"""
+
+        if self.index >= self.nbr:
+            # Relecture en boucle
+            self.index = 0
+            self.t_start = None
+
+        if self.t_start is None:
+            self.t_start = time()
+
+        if self.speed:
+            delay = self.t_start + self.timestamps[self.index]/self.speed - time()
+            if delay > 0:
+                sleep(delay)
+
+        # Les squelettes sont dessinés dans la couleur, la profondeur n'est
+        # que lue
+        color_frame = ReplayFrame(self.color[self.index].copy())
+        depth_frame = ReplayFrame(self.depth[self.index], self.depth_scale)
+        self.index += 1
+
+        return ReplayFrames(color_frame, depth_frame)
+
+    def stop(self):
+        pass
+
+
+def intrinsics_to_dict(intrinsic):
+    """rs.intrinsics ou ReplayIntrinsics vers dict pour le json"""
+
+    return {'width': intrinsic.width,
+            'height': intrinsic.height,
+            'ppx': intrinsic.ppx,
+            'ppy': intrinsic.ppy,
+            'fx': intrinsic.fx,
+            'fy': intrinsic.fy,
+            # rs.distortion.inverse_brown_conrady --> inverse_brown_conrady
+            'model': str(intrinsic.model).split('.')[-1],
+            'coeffs': [float(c) for c in intrinsic.coeffs]}
+
+
+def dict_to_intrinsics(d):
+    """Retourne un rs.intrinsics si pyrealsense2 est installé,
+    sinon un ReplayIntrinsics avec les mêmes attributs
+    """
+
+    if rs is None:
+        return ReplayIntrinsics(d)
+
+    intrinsic = rs.intrinsics()
+    intrinsic.width = d['width']
+    intrinsic.height = d['height']
+    intrinsic.ppx = d['ppx']
+    intrinsic.ppy = d['ppy']
+    intrinsic.fx = d['fx']
+    intrinsic.fy = d['fy']
+    intrinsic.model = getattr(rs.distortion, d['model'])
+    intrinsic.coeffs = d['coeffs']
+
+    return intrinsic
+
+
+def record_session(session_dir, nbr):
+    """Enregistre nbr captures alignées de la caméra dans session_dir"""
+
+    from my_realsense import MyRealSense
+
+    config = {'camera': {   'width_input': 1280,
+                            'height_input': 720,
+                            'depth_width': 1280,
+                            'depth_height': 720,
+                            'decimation': 1,
+                            'replay': '',
+                            'replay_speed': 1,
+                            'record': session_dir,
+                            'capture_thread': 0,
+                            'align': 1}}
+    mrs = MyRealSense(config)
+
+    for i in range(nbr):
+        frames = mrs.pipeline.wait_for_frames()
+        aligned_frames = mrs.process_frames(frames)
+        color = aligned_frames.get_color_frame()
+        depth = aligned_frames.get_depth_frame()
+        if not depth or not color:
+            continue
+        mrs.recorder.add(np.asanyarray(color.get_data()),
+                         np.asanyarray(depth.get_data()))
+
+    mrs.recorder.close()
+    mrs.pipeline.stop()
+
+
+
+if __name__ == "__main__":
+
+    record_session(sys.argv[1], int(sys.argv[2]))
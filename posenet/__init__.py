@@ -1,5 +1,7 @@
 from posenet.constants import *
-from posenet.decode_multi import decode_multiple_poses
-from posenet.models.model_factory import load_model
+from posenet.decode_multi import decode_multiple_poses, decode_multiple_poses_vectorized, decode_single_pose_near
+from posenet.decode_torch import decode_multiple_poses_torch, decode_single_pose_near_torch
+from posenet.models.model_factory import load_model, load_compiled_model, export_onnx
+from posenet.models.quantization import quantize_model, load_quantized_model
 from posenet.models import MobileNetV1, MOBILENET_V1_CHECKPOINTS
 from posenet.utils import *
@@ -67,3 +67,73 @@ def decode_pose(
             instance_keypoint_coords[target_keypoint_id] = coords
 
     return instance_keypoint_scores, instance_keypoint_coords
+
+
+def traverse_to_targ_keypoints(
+        edge_id, source_keypoints, target_keypoint_id, scores, offsets, output_stride, displacements
+):
+    """traverse_to_targ_keypoint for all the source keypoints (N, 2) at once"""
+    height = scores.shape[1]
+    width = scores.shape[2]
+    max_indices = np.array([height - 1, width - 1])
+
+    source_keypoint_indices = np.clip(
+        np.round(source_keypoints / output_stride), a_min=0, a_max=max_indices).astype(np.int32)
+
+    displaced_points = source_keypoints + displacements[
+        edge_id, source_keypoint_indices[:, 0], source_keypoint_indices[:, 1]]
+
+    displaced_point_indices = np.clip(
+        np.round(displaced_points / output_stride), a_min=0, a_max=max_indices).astype(np.int32)
+
+    score = scores[target_keypoint_id, displaced_point_indices[:, 0], displaced_point_indices[:, 1]]
+
+    image_coords = displaced_point_indices * output_stride + offsets[
+        target_keypoint_id, displaced_point_indices[:, 0], displaced_point_indices[:, 1]]
+
+    return score, image_coords
+
+
+def decode_poses(
+        root_scores, root_ids, root_image_coords,
+        scores,
+        offsets,
+        output_stride,
+        displacements_fwd,
+        displacements_bwd
+):
+    """decode_pose for all the N roots together, one edge at a time.
+    Returns keypoint scores (N, num_parts) and coords (N, num_parts, 2)
+    """
+    num_roots = len(root_scores)
+    num_parts = scores.shape[0]
+    num_edges = len(PARENT_CHILD_TUPLES)
+    roots = np.arange(num_roots)
+
+    instance_keypoint_scores = np.zeros((num_roots, num_parts))
+    instance_keypoint_coords = np.zeros((num_roots, num_parts, 2))
+    instance_keypoint_scores[roots, root_ids] = root_scores
+    instance_keypoint_coords[roots, root_ids] = root_image_coords
+
+    def traverse(edge, source_keypoint_id, target_keypoint_id, displacements):
+        todo = ((instance_keypoint_scores[:, source_keypoint_id] > 0.0) &
+                (instance_keypoint_scores[:, target_keypoint_id] == 0.0)).nonzero()[0]
+        if not len(todo):
+            return
+        score, coords = traverse_to_targ_keypoints(
+            edge,
+            instance_keypoint_coords[todo, source_keypoint_id],
+            target_keypoint_id,
+            scores, offsets, output_stride, displacements)
+        instance_keypoint_scores[todo, target_keypoint_id] = score
+        instance_keypoint_coords[todo, target_keypoint_id] = coords
+
+    for edge in reversed(range(num_edges)):
+        target_keypoint_id, source_keypoint_id = PARENT_CHILD_TUPLES[edge]
+        traverse(edge, source_keypoint_id, target_keypoint_id, displacements_bwd)
+
+    for edge in range(num_edges):
+        source_keypoint_id, target_keypoint_id = PARENT_CHILD_TUPLES[edge]
+        traverse(edge, source_keypoint_id, target_keypoint_id, displacements_fwd)
+
+    return instance_keypoint_scores, instance_keypoint_coords
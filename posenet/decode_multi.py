@@ -5,35 +5,62 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 
-def within_nms_radius_fast(pose_coords, squared_nms_radius, point):
-    if not pose_coords.shape[0]:
-        return False
-    return np.any(np.sum((pose_coords - point) ** 2, axis=1) <= squared_nms_radius)
+# The NMS checks the roots by chunks, growing from NMS_FIRST_CHUNK to NMS_MAX_CHUNK roots
+NMS_FIRST_CHUNK = 8
+NMS_MAX_CHUNK = 128
 
-
-def get_instance_score_fast(
-        exist_pose_coords,
-        squared_nms_radius,
-        keypoint_scores, keypoint_coords):
-
-    if exist_pose_coords.shape[0]:
-        s = np.sum((exist_pose_coords - keypoint_coords) ** 2, axis=2) > squared_nms_radius
-        not_overlapped_scores = np.sum(keypoint_scores[np.all(s, axis=0)])
+def build_part_with_score_torch(score_threshold, local_max_radius, scores, max_candidates=None,
+                                column_mask=None):
+    """Local maxima above score_threshold, sorted by score, the max_candidates best ones if set.
+    column_mask (width,) bool: only the heatmap columns set to True can hold a root
+    """
+    lmd = 2 * local_max_radius + 1
+    max_vals = F.max_pool2d(scores, lmd, stride=1, padding=1)
+    max_loc = (scores == max_vals) & (scores >= score_threshold)
+    if column_mask is not None:
+        max_loc &= torch.as_tensor(column_mask, device=scores.device)
+    max_loc_idx = max_loc.nonzero()
+    scores_vec = scores[max_loc]
+    if max_candidates and scores_vec.shape[0] > max_candidates:
+        _, sort_idx = torch.topk(scores_vec, max_candidates)
     else:
-        not_overlapped_scores = np.sum(keypoint_scores)
-    return not_overlapped_scores / len(keypoint_scores)
+        sort_idx = torch.argsort(scores_vec, descending=True)
+    return scores_vec[sort_idx], max_loc_idx[sort_idx]
 
 
-def build_part_with_score_torch(score_threshold, local_max_radius, scores):
+def build_part_with_score_numpy(score_threshold, local_max_radius, scores, max_candidates=None,
+                                column_mask=None):
+    """Same as build_part_with_score_torch, for the numpy outputs of onnxruntime"""
+    num_keypoints, height, width = scores.shape
     lmd = 2 * local_max_radius + 1
-    max_vals = F.max_pool2d(scores, lmd, stride=1, padding=1)
+    padded = np.full((num_keypoints, height + 2, width + 2), -np.inf, dtype=scores.dtype)
+    padded[:, 1:-1, 1:-1] = scores
+    # max_pool2d with padding=1, as in the torch version
+    out_h = height + 3 - lmd
+    out_w = width + 3 - lmd
+    max_vals = padded[:, :out_h, :out_w].copy()
+    for dy in range(lmd):
+        for dx in range(lmd):
+            np.maximum(max_vals, padded[:, dy:dy + out_h, dx:dx + out_w], out=max_vals)
     max_loc = (scores == max_vals) & (scores >= score_threshold)
-    max_loc_idx = max_loc.nonzero()
+    if column_mask is not None:
+        max_loc &= column_mask
+    max_loc_idx = np.argwhere(max_loc)
     scores_vec = scores[max_loc]
-    sort_idx = torch.argsort(scores_vec, descending=True)
+    if max_candidates and len(scores_vec) > max_candidates:
+        top_idx = np.sort(np.argpartition(-scores_vec, max_candidates - 1)[:max_candidates])
+        sort_idx = top_idx[np.argsort(-scores_vec[top_idx], kind='stable')]
+    else:
+        sort_idx = np.argsort(-scores_vec, kind='stable')
     return scores_vec[sort_idx], max_loc_idx[sort_idx]
 
 
+def to_numpy(tensor):
+    if isinstance(tensor, np.ndarray):
+        return tensor
+    return tensor.cpu().numpy()
+
+
 # FIXME leaving here as reference for now
 # def build_part_with_score_fast(score_threshold, local_max_radius, scores):
 #     parts = []
@@ -58,57 +85,191 @@ def build_part_with_score_torch(score_threshold, local_max_radius, scores):
 #    return parts
 
 
-def decode_multiple_poses(
-        scores, offsets, displacements_fwd, displacements_bwd, output_stride,
-        max_pose_detections=10, score_threshold=0.5, nms_radius=20, min_pose_score=0.5):
-
-    # perform part scoring step on GPU as it's expensive
-    # TODO determine how much more of this would be worth performing on the GPU
-    part_scores, part_idx = build_part_with_score_torch(score_threshold, LOCAL_MAXIMUM_RADIUS, scores)
-    part_scores = part_scores.cpu().numpy()
-    part_idx = part_idx.cpu().numpy()
+def prepare_outputs(scores, offsets, displacements_fwd, displacements_bwd, output_stride,
+                    score_threshold, max_candidates=None, column_mask=None, root_filter=None):
+    """Candidate roots sorted by score, their image coords, and the model outputs as numpy arrays.
+    root_filter(root_ids, root_image_coords) returns a bool array of the roots to decode.
+    """
+    if isinstance(scores, np.ndarray):
+        # outputs of the onnxruntime backend, already on the CPU
+        part_scores, part_idx = build_part_with_score_numpy(
+            score_threshold, LOCAL_MAXIMUM_RADIUS, scores, max_candidates, column_mask)
+    else:
+        # perform part scoring step on GPU as it's expensive
+        # TODO determine how much more of this would be worth performing on the GPU
+        part_scores, part_idx = build_part_with_score_torch(
+            score_threshold, LOCAL_MAXIMUM_RADIUS, scores, max_candidates, column_mask)
+        part_scores = part_scores.cpu().numpy()
+        part_idx = part_idx.cpu().numpy()
 
-    scores = scores.cpu().numpy()
+    scores = to_numpy(scores)
     height = scores.shape[1]
     width = scores.shape[2]
     # change dimensions from (x, h, w) to (x//2, h, w, 2) to allow return of complete coord array
-    offsets = offsets.cpu().numpy().reshape(2, -1, height, width).transpose((1, 2, 3, 0))
-    displacements_fwd = displacements_fwd.cpu().numpy().reshape(2, -1, height, width).transpose((1, 2, 3, 0))
-    displacements_bwd = displacements_bwd.cpu().numpy().reshape(2, -1, height, width).transpose((1, 2, 3, 0))
+    offsets = to_numpy(offsets).reshape(2, -1, height, width).transpose((1, 2, 3, 0))
+    displacements_fwd = to_numpy(displacements_fwd).reshape(2, -1, height, width).transpose((1, 2, 3, 0))
+    displacements_bwd = to_numpy(displacements_bwd).reshape(2, -1, height, width).transpose((1, 2, 3, 0))
+
+    root_ids = part_idx[:, 0]
+    root_image_coords = part_idx[:, 1:] * output_stride + offsets[root_ids, part_idx[:, 1], part_idx[:, 2]]
+
+    if root_filter is not None and len(root_ids):
+        keep = root_filter(root_ids, root_image_coords)
+        part_scores, root_ids, root_image_coords = part_scores[keep], root_ids[keep], root_image_coords[keep]
 
+    return part_scores, root_ids, root_image_coords, scores, offsets, displacements_fwd, displacements_bwd
+
+
+def select_poses(root_ids, root_image_coords, decode, max_pose_detections, nms_radius, min_pose_score,
+                 max_chunk=NMS_MAX_CHUNK):
+    """Sequential acceptance of the candidate roots, in score order.
+    A root within nms_radius of the same keypoint of an accepted pose is skipped,
+    decode(indices) returns the keypoint scores (n, 17) and coords (n, 17, 2) of the poses
+    of the roots indices.
+
+    The roots are checked and decoded by chunks, against all the poses accepted before the
+    chunk at once, so only the poses accepted inside the chunk are scanned one root at a time.
+    The chunks grow from NMS_FIRST_CHUNK roots: when the poses are accepted early, only a few
+    roots are decoded. max_chunk=1 decodes the roots one at a time.
+    """
     squared_nms_radius = nms_radius ** 2
+    num_roots = len(root_ids)
     pose_count = 0
     pose_scores = np.zeros(max_pose_detections)
     pose_keypoint_scores = np.zeros((max_pose_detections, NUM_KEYPOINTS))
     pose_keypoint_coords = np.zeros((max_pose_detections, NUM_KEYPOINTS, 2))
 
-    for root_score, (root_id, root_coord_y, root_coord_x) in zip(part_scores, part_idx):
-        root_coord = np.array([root_coord_y, root_coord_x])
-        root_image_coords = root_coord * output_stride + offsets[root_id, root_coord_y, root_coord_x]
+    start = 0
+    chunk_size = min(NMS_FIRST_CHUNK, max_chunk)
+    while start < num_roots and pose_count < max_pose_detections:
+        stop = min(start + chunk_size, num_roots)
+        chunk_size = min(2 * chunk_size, max_chunk)
+        chunk_count = pose_count
 
-        if within_nms_radius_fast(
-                pose_keypoint_coords[:pose_count, root_id, :], squared_nms_radius, root_image_coords):
+        if pose_count:
+            suppressed = np.any(np.sum(
+                (pose_keypoint_coords[:pose_count, root_ids[start:stop]] - root_image_coords[start:stop]) ** 2,
+                axis=2) <= squared_nms_radius, axis=0)
+            candidates = start + np.flatnonzero(~suppressed)
+        else:
+            candidates = np.arange(start, stop)
+        start = stop
+        if not len(candidates):
             continue
 
+        keypoint_scores, keypoint_coords = decode(candidates)
+
+        # the keypoints farther than nms_radius from the same keypoint of every pose accepted
+        # before the chunk
+        if pose_count:
+            not_overlapped = np.all(np.sum(
+                (pose_keypoint_coords[:pose_count, np.newaxis] - keypoint_coords) ** 2, axis=3) > squared_nms_radius,
+                axis=0)
+        else:
+            not_overlapped = np.ones(keypoint_scores.shape, dtype=bool)
+
+        for j, i in enumerate(candidates):
+
+            if pose_count > chunk_count:
+                # the poses accepted inside the chunk
+                if np.any(np.sum(
+                        (pose_keypoint_coords[chunk_count:pose_count, root_ids[i]] - root_image_coords[i]) ** 2,
+                        axis=1) <= squared_nms_radius):
+                    continue
+                not_overlapped[j] &= np.all(np.sum(
+                    (pose_keypoint_coords[chunk_count:pose_count] - keypoint_coords[j]) ** 2,
+                    axis=2) > squared_nms_radius, axis=0)
+
+            pose_score = np.sum(keypoint_scores[j][not_overlapped[j]]) / NUM_KEYPOINTS
+
+            # NOTE this isn't in the original implementation, but it appears that by initially ordering by
+            # part scores, and having a max # of detections, we can end up populating the returned poses with
+            # lower scored poses than if we discard 'bad' ones and continue (higher pose scores can still come later).
+            # Set min_pose_score to 0. to revert to original behaviour
+            if min_pose_score == 0. or pose_score >= min_pose_score:
+                pose_scores[pose_count] = pose_score
+                pose_keypoint_scores[pose_count, :] = keypoint_scores[j]
+                pose_keypoint_coords[pose_count, :, :] = keypoint_coords[j]
+                pose_count += 1
+
+            if pose_count >= max_pose_detections:
+                break
+
+    return pose_scores, pose_keypoint_scores, pose_keypoint_coords
+
+
+def decode_multiple_poses(
+        scores, offsets, displacements_fwd, displacements_bwd, output_stride,
+        max_pose_detections=10, score_threshold=0.5, nms_radius=20, min_pose_score=0.5,
+        max_candidates=None, column_mask=None, root_filter=None):
+    """Reference decoder, one root and one edge at a time"""
+
+    part_scores, root_ids, root_image_coords, scores, offsets, displacements_fwd, displacements_bwd = \
+        prepare_outputs(scores, offsets, displacements_fwd, displacements_bwd, output_stride,
+                        score_threshold, max_candidates, column_mask, root_filter)
+
+    def decode(indices):
+        i, = indices
         keypoint_scores, keypoint_coords = decode_pose(
-            root_score, root_id, root_image_coords,
+            part_scores[i], root_ids[i], root_image_coords[i],
+            scores, offsets, output_stride,
+            displacements_fwd, displacements_bwd)
+        return keypoint_scores[np.newaxis], keypoint_coords[np.newaxis]
+
+    return select_poses(root_ids, root_image_coords, decode, max_pose_detections, nms_radius, min_pose_score,
+                        max_chunk=1)
+
+
+def decode_multiple_poses_vectorized(
+        scores, offsets, displacements_fwd, displacements_bwd, output_stride,
+        max_pose_detections=10, score_threshold=0.5, nms_radius=20, min_pose_score=0.5,
+        max_candidates=None, column_mask=None, root_filter=None):
+    """Same results as decode_multiple_poses, the roots of each chunk of select_poses
+    that are not suppressed are decoded together, one edge at a time
+    """
+    part_scores, root_ids, root_image_coords, scores, offsets, displacements_fwd, displacements_bwd = \
+        prepare_outputs(scores, offsets, displacements_fwd, displacements_bwd, output_stride,
+                        score_threshold, max_candidates, column_mask, root_filter)
+
+    def decode(indices):
+        return decode_poses(
+            part_scores[indices], root_ids[indices], root_image_coords[indices],
             scores, offsets, output_stride,
             displacements_fwd, displacements_bwd)
 
-        pose_score = get_instance_score_fast(
-            pose_keypoint_coords[:pose_count, :, :], squared_nms_radius, keypoint_scores, keypoint_coords)
+    return select_poses(root_ids, root_image_coords, decode, max_pose_detections, nms_radius, min_pose_score)
 
-        # NOTE this isn't in the original implementation, but it appears that by initially ordering by
-        # part scores, and having a max # of detections, we can end up populating the returned poses with
-        # lower scored poses than if we discard 'bad' ones and continue (higher pose scores can still come later).
-        # Set min_pose_score to 0. to revert to original behaviour
-        if min_pose_score == 0. or pose_score >= min_pose_score:
-            pose_scores[pose_count] = pose_score
-            pose_keypoint_scores[pose_count, :] = keypoint_scores
-            pose_keypoint_coords[pose_count, :, :] = keypoint_coords
-            pose_count += 1
 
-        if pose_count >= max_pose_detections:
-            break
+def decode_single_pose_near(
+        scores, offsets, displacements_fwd, displacements_bwd, output_stride,
+        target_coords, target_valid, search_radius=32, score_threshold=0.5, min_pose_score=0.5,
+        max_candidates=None, column_mask=None, root_filter=None):
+    """Decodes only the pose of the best root near the target pose of the previous frame.
+    target_coords (17, 2) y, x and target_valid (17,) bool: the keypoints of the target,
+    a candidate root must be within search_radius of the same keypoint of the target.
 
-    return pose_scores, pose_keypoint_scores, pose_keypoint_coords
+    Returns the same arrays as decode_multiple_poses for one pose,
+    or None if the target is lost: no root near it, or a pose score below min_pose_score.
+    """
+    part_scores, root_ids, root_image_coords, scores, offsets, displacements_fwd, displacements_bwd = \
+        prepare_outputs(scores, offsets, displacements_fwd, displacements_bwd, output_stride,
+                        score_threshold, max_candidates, column_mask, root_filter)
+
+    near = target_valid[root_ids] & (
+        np.sum((root_image_coords - target_coords[root_ids]) ** 2, axis=1) <= search_radius ** 2)
+    if not near.any():
+        return None
+
+    # the candidates are sorted by score, the first one near the target is the best
+    i = np.argmax(near)
+    keypoint_scores, keypoint_coords = decode_poses(
+        part_scores[i:i + 1], root_ids[i:i + 1], root_image_coords[i:i + 1],
+        scores, offsets, output_stride,
+        displacements_fwd, displacements_bwd)
+
+    # no other pose, nothing overlaps
+    pose_scores = np.mean(keypoint_scores, axis=1)
+    if min_pose_score != 0. and pose_scores[0] < min_pose_score:
+        return None
+
+    return pose_scores, keypoint_scores, keypoint_coords
@@ -0,0 +1,177 @@
+import numpy as np
+import torch
+
+from posenet.constants import *
+from posenet.decode_multi import build_part_with_score_torch, select_poses
+
+
+def traverse_to_targ_keypoints_torch(
+        edge_id, source_keypoints, target_keypoint_id, scores, offsets, output_stride, displacements
+):
+    """traverse_to_targ_keypoints on the device, gathering only the visited positions.
+    offsets and displacements are the raw heads, (2 * n, h, w) with y first then x
+    """
+    height = scores.shape[1]
+    width = scores.shape[2]
+    num_edges = displacements.shape[0] // 2
+    num_parts = offsets.shape[0] // 2
+
+    source_y = torch.clamp(torch.round(source_keypoints[:, 0] / output_stride), 0, height - 1).long()
+    source_x = torch.clamp(torch.round(source_keypoints[:, 1] / output_stride), 0, width - 1).long()
+
+    displaced_y = source_keypoints[:, 0] + displacements[edge_id, source_y, source_x].double()
+    displaced_x = source_keypoints[:, 1] + displacements[edge_id + num_edges, source_y, source_x].double()
+
+    displaced_y = torch.clamp(torch.round(displaced_y / output_stride), 0, height - 1).long()
+    displaced_x = torch.clamp(torch.round(displaced_x / output_stride), 0, width - 1).long()
+
+    score = scores[target_keypoint_id, displaced_y, displaced_x].double()
+
+    image_coords = torch.stack((
+        displaced_y * output_stride + offsets[target_keypoint_id, displaced_y, displaced_x].double(),
+        displaced_x * output_stride + offsets[target_keypoint_id + num_parts, displaced_y, displaced_x].double()),
+        dim=1)
+
+    return score, image_coords
+
+
+def decode_poses_torch(
+        root_scores, root_ids, root_image_coords,
+        scores, offsets, output_stride,
+        displacements_fwd, displacements_bwd
+):
+    """decode_poses for all the roots on the device.
+    Returns a (N, num_parts, 3) tensor of y, x, score
+    """
+    num_roots = root_scores.shape[0]
+    num_parts = scores.shape[0]
+    num_edges = len(PARENT_CHILD_TUPLES)
+    roots = torch.arange(num_roots, device=scores.device)
+
+    keypoints = torch.zeros((num_roots, num_parts, 3), dtype=torch.float64, device=scores.device)
+    keypoints[roots, root_ids, :2] = root_image_coords
+    keypoints[roots, root_ids, 2] = root_scores.double()
+
+    def traverse(edge, source_keypoint_id, target_keypoint_id, displacements):
+        todo = (keypoints[:, source_keypoint_id, 2] > 0.0) & (keypoints[:, target_keypoint_id, 2] == 0.0)
+        score, coords = traverse_to_targ_keypoints_torch(
+            edge, keypoints[:, source_keypoint_id, :2], target_keypoint_id,
+            scores, offsets, output_stride, displacements)
+        # every root is traversed, only the ones in todo are kept: no sync with the host
+        keypoints[:, target_keypoint_id, :2] = torch.where(
+            todo[:, None], coords, keypoints[:, target_keypoint_id, :2])
+        keypoints[:, target_keypoint_id, 2] = torch.where(
+            todo, score, keypoints[:, target_keypoint_id, 2])
+
+    for edge in reversed(range(num_edges)):
+        target_keypoint_id, source_keypoint_id = PARENT_CHILD_TUPLES[edge]
+        traverse(edge, source_keypoint_id, target_keypoint_id, displacements_bwd)
+
+    for edge in range(num_edges):
+        source_keypoint_id, target_keypoint_id = PARENT_CHILD_TUPLES[edge]
+        traverse(edge, source_keypoint_id, target_keypoint_id, displacements_fwd)
+
+    return keypoints
+
+
+def prepare_roots_torch(scores, offsets, output_stride, score_threshold, max_candidates=None,
+                        column_mask=None, root_filter=None):
+    """Candidate roots sorted by score and their image coords, as tensors on the device.
+    Only root_filter, if set, copies the roots to the host.
+    """
+    part_scores, part_idx = build_part_with_score_torch(
+        score_threshold, LOCAL_MAXIMUM_RADIUS, scores, max_candidates, column_mask)
+
+    num_parts = scores.shape[0]
+    root_ids = part_idx[:, 0]
+    root_y = part_idx[:, 1]
+    root_x = part_idx[:, 2]
+    root_image_coords = torch.stack((
+        root_y * output_stride + offsets[root_ids, root_y, root_x].double(),
+        root_x * output_stride + offsets[root_ids + num_parts, root_y, root_x].double()),
+        dim=1)
+
+    if root_filter is not None and root_ids.shape[0]:
+        keep = root_filter(root_ids.cpu().numpy(), root_image_coords.cpu().numpy())
+        keep = torch.as_tensor(keep, device=scores.device)
+        part_scores, root_ids, root_image_coords = part_scores[keep], root_ids[keep], root_image_coords[keep]
+
+    return part_scores, root_ids, root_image_coords
+
+
+def decode_multiple_poses_torch(
+        scores, offsets, displacements_fwd, displacements_bwd, output_stride,
+        max_pose_detections=10, score_threshold=0.5, nms_radius=20, min_pose_score=0.5,
+        max_candidates=None, column_mask=None, root_filter=None):
+    """Same results as decode_multiple_poses, the heads stay on the device as tensors.
+    Only the decoded candidate poses are copied to the host for the sequential acceptance.
+
+    Returns pose_scores (P,) and a compact (P, 17, 3) array of y, x, score
+    for the P accepted poses.
+    """
+    if isinstance(scores, np.ndarray):
+        scores, offsets, displacements_fwd, displacements_bwd = [
+            torch.from_numpy(t) for t in (scores, offsets, displacements_fwd, displacements_bwd)]
+
+    part_scores, root_ids, root_image_coords = prepare_roots_torch(
+        scores, offsets, output_stride, score_threshold, max_candidates, column_mask, root_filter)
+
+    keypoints = decode_poses_torch(
+        part_scores, root_ids, root_image_coords,
+        scores, offsets, output_stride,
+        displacements_fwd, displacements_bwd)
+
+    # the only copy to the host: (N, 17, 3) for the N candidate roots
+    keypoints = keypoints.cpu().numpy()
+    root_ids = root_ids.cpu().numpy()
+
+    def decode(indices):
+        return keypoints[indices, :, 2], keypoints[indices, :, :2]
+
+    pose_scores, keypoint_scores, keypoint_coords = select_poses(
+        root_ids, keypoints[np.arange(len(root_ids)), root_ids, :2], decode,
+        max_pose_detections, nms_radius, min_pose_score)
+
+    # accepted poses are the first ones, their root has a score
+    count = np.count_nonzero(keypoint_scores.any(axis=1))
+    poses = np.concatenate((keypoint_coords[:count], keypoint_scores[:count, :, None]), axis=2)
+
+    return pose_scores[:count], poses
+
+
+def decode_single_pose_near_torch(
+        scores, offsets, displacements_fwd, displacements_bwd, output_stride,
+        target_coords, target_valid, search_radius=32, score_threshold=0.5, min_pose_score=0.5,
+        max_candidates=None, column_mask=None, root_filter=None):
+    """Same results as decode_single_pose_near, the heads stay on the device as tensors.
+    The root near the target is chosen and decoded on the device, only its pose is copied
+    to the host.
+    """
+    if isinstance(scores, np.ndarray):
+        scores, offsets, displacements_fwd, displacements_bwd = [
+            torch.from_numpy(t) for t in (scores, offsets, displacements_fwd, displacements_bwd)]
+
+    part_scores, root_ids, root_image_coords = prepare_roots_torch(
+        scores, offsets, output_stride, score_threshold, max_candidates, column_mask, root_filter)
+
+    target_coords = torch.as_tensor(target_coords, dtype=torch.float64, device=scores.device)
+    target_valid = torch.as_tensor(target_valid, dtype=torch.bool, device=scores.device)
+    near = target_valid[root_ids] & (
+        torch.sum((root_image_coords - target_coords[root_ids]) ** 2, dim=1) <= search_radius ** 2)
+    if not bool(near.any()):
+        return None
+
+    # the candidates are sorted by score, the first one near the target is the best
+    i = int(torch.argmax(near.byte()))
+    keypoints = decode_poses_torch(
+        part_scores[i:i + 1], root_ids[i:i + 1], root_image_coords[i:i + 1],
+        scores, offsets, output_stride,
+        displacements_fwd, displacements_bwd).cpu().numpy()
+    keypoint_scores, keypoint_coords = keypoints[:, :, 2], keypoints[:, :, :2]
+
+    # no other pose, nothing overlaps
+    pose_scores = np.mean(keypoint_scores, axis=1)
+    if min_pose_score != 0. and pose_scores[0] < min_pose_score:
+        return None
+
+    return pose_scores, keypoint_scores, keypoint_coords
@@ -1,5 +1,6 @@
 import torch
 import os
+import inspect
 
 
 from posenet.models.mobilenet_v1 import MobileNetV1, MOBILENET_V1_CHECKPOINTS
@@ -25,3 +26,105 @@ def load_model(model_id, output_stride=16, model_dir=MODEL_DIR):
     model.load_state_dict(load_dict)
 
     return model
+
+
+def compiled_model_path(model_id, output_stride, input_size, device, cache_dir):
+    """Le nom du fichier est la clé du cache: model, output stride,
+    taille d'entrée, device et version de torch
+    """
+    width, height = input_size
+    name = '%s_s%d_%dx%d_%s_torch%s.pt' % (
+        MOBILENET_V1_CHECKPOINTS[model_id], output_stride, width, height,
+        device.replace(':', ''), torch.__version__.replace('+', '_'))
+    return os.path.join(cache_dir, name)
+
+
+def load_compiled_model(model_id, output_stride=16, input_size=(1281, 721),
+                        device='cpu', model_dir=MODEL_DIR, cache_dir=None):
+    """Model TorchScript tracé, figé et optimisé pour l'inférence,
+    lu dans le cache s'il existe, sinon construit et sauvé dans le cache.
+    input_size = (largeur, hauteur) du tenseur d'entrée
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(model_dir, 'torchscript')
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    model_path = os.path.join(model_dir, MOBILENET_V1_CHECKPOINTS[model_id] + '.pth')
+    path = compiled_model_path(model_id, output_stride, input_size, device, cache_dir)
+
+    frozen = None
+    # Reconstruit si le .pth est plus récent que le cache
+    if os.path.exists(path) and os.path.exists(model_path) and \
+            os.path.getmtime(path) >= os.path.getmtime(model_path):
+        try:
+            frozen = torch.jit.load(path, map_location=device)
+        except RuntimeError:
+            print('Cannot load compiled model %s, rebuilding...' % path)
+
+    if frozen is None:
+        print('Building compiled model %s' % path)
+        model = load_model(model_id, output_stride=output_stride, model_dir=model_dir)
+        model = model.to(device).eval()
+        width, height = input_size
+        example = torch.zeros((1, 3, height, width), device=device)
+
+        with torch.no_grad():
+            traced = torch.jit.trace(model, example)
+            frozen = torch.jit.freeze(traced)
+
+        # Le model optimisé ne se sauve pas, seul le model figé est en cache
+        torch.jit.save(frozen, path)
+
+    return torch.jit.optimize_for_inference(frozen)
+
+
+ONNX_OUTPUT_NAMES = ['heatmap', 'offset', 'displacement_fwd', 'displacement_bwd']
+
+
+def onnx_model_path(model_id, output_stride, cache_dir):
+    # Les axes dynamiques sont dans le nom: un ancien export avec le batch
+    # fixé à 1, aussi récent que le .pth, n'est pas réutilisé
+    name = '%s_s%d_dyn_batch.onnx' % (MOBILENET_V1_CHECKPOINTS[model_id], output_stride)
+    return os.path.join(cache_dir, name)
+
+
+def export_onnx(model_id, output_stride=16, model_dir=MODEL_DIR, cache_dir=None,
+                opset_version=13):
+    """Exporte MobileNetV1 en ONNX, batch, hauteur et largeur dynamiques,
+    dans model_dir/onnx. L'export est refait si le .pth est plus récent.
+    Retourne le chemin du fichier .onnx
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(model_dir, 'onnx')
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    model_path = os.path.join(model_dir, MOBILENET_V1_CHECKPOINTS[model_id] + '.pth')
+    path = onnx_model_path(model_id, output_stride, cache_dir)
+
+    if os.path.exists(path) and os.path.exists(model_path) and \
+            os.path.getmtime(path) >= os.path.getmtime(model_path):
+        return path
+
+    print('Exporting ONNX model %s' % path)
+    model = load_model(model_id, output_stride=output_stride, model_dir=model_dir)
+    model = model.cpu().eval()
+    example = torch.zeros((1, 3, 721, 1281))
+    dynamic_axes = {name: {0: 'batch', 2: 'height', 3: 'width'}
+                    for name in ['input'] + ONNX_OUTPUT_NAMES}
+
+    kwargs = {}
+    # Les torch récents exportent par défaut avec dynamo, sans dynamic_axes
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False
+
+    with torch.no_grad():
+        torch.onnx.export(model, example, path,
+                          input_names=['input'],
+                          output_names=ONNX_OUTPUT_NAMES,
+                          dynamic_axes=dynamic_axes,
+                          opset_version=opset_version,
+                          **kwargs)
+
+    return path
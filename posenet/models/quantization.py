@@ -0,0 +1,151 @@
+"""
+Quantification int8 de MobileNetV1 pour le CPU
+
+Chaque conv suivie de ReLU6 devient une seule conv quantifiée: sa sortie est
+quantifiée sur [0, 6], ce qui coupe les valeurs exactement comme ReLU6.
+Les 4 têtes sont déquantifiées, le sigmoid des heatmaps reste en float.
+"""
+
+import os
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.quantization import QuantStub, DeQuantStub, QConfig, MinMaxObserver,\
+    default_per_channel_weight_observer, get_default_qconfig
+
+from posenet.models.mobilenet_v1 import InputConv, SeperableConv,\
+    MOBILENET_V1_CHECKPOINTS
+from posenet.models.model_factory import load_model, MODEL_DIR
+
+
+class ReLU6Observer(MinMaxObserver):
+    """Plage fixe [0, 6] quelles que soient les valeurs de calibration"""
+
+    def forward(self, x_orig):
+        self.min_val.fill_(0.)
+        self.max_val.fill_(6.)
+        return x_orig
+
+
+class ConvReLU6(nn.Module):
+    """Conv suivie de ReLU6, fusionnées une fois quantifiées"""
+
+    def __init__(self, conv):
+        super(ConvReLU6, self).__init__()
+        self.conv = conv
+
+    def forward(self, x):
+        x = self.conv(x)
+        # Model float pendant la calibration, ReLU6 à appliquer
+        if not x.is_quantized:
+            x = F.relu6(x)
+        return x
+
+
+def fuse_relu6(model, qconfig_relu6):
+    """Remplace les blocs InputConv et SeperableConv par des ConvReLU6"""
+    for name, block in model.features.named_children():
+        if isinstance(block, InputConv):
+            fused = ConvReLU6(block.conv)
+        elif isinstance(block, SeperableConv):
+            fused = nn.Sequential(ConvReLU6(block.depthwise), ConvReLU6(block.pointwise))
+        else:
+            continue
+        for m in fused.modules():
+            if isinstance(m, nn.Conv2d):
+                m.qconfig = qconfig_relu6
+        setattr(model.features, name, fused)
+
+
+class QuantizableMobileNetV1(nn.Module):
+    """MobileNetV1 avec quantification de l'entrée, déquantification des têtes"""
+
+    def __init__(self, model):
+        super(QuantizableMobileNetV1, self).__init__()
+        self.output_stride = model.output_stride
+        self.quant = QuantStub()
+        self.features = model.features
+        self.heatmap = model.heatmap
+        self.offset = model.offset
+        self.displacement_fwd = model.displacement_fwd
+        self.displacement_bwd = model.displacement_bwd
+        self.dequant = DeQuantStub()
+
+    def forward(self, x):
+        x = self.features(self.quant(x))
+        heatmap = torch.sigmoid(self.dequant(self.heatmap(x)))
+        offset = self.dequant(self.offset(x))
+        displacement_fwd = self.dequant(self.displacement_fwd(x))
+        displacement_bwd = self.dequant(self.displacement_bwd(x))
+        return heatmap, offset, displacement_fwd, displacement_bwd
+
+
+def default_engine():
+    """fbgemm sur x86, qnnpack sur ARM"""
+    engines = torch.backends.quantized.supported_engines
+    return 'fbgemm' if 'fbgemm' in engines else 'qnnpack'
+
+
+def quantized_model_path(model_id, model_dir=MODEL_DIR):
+    return os.path.join(model_dir, MOBILENET_V1_CHECKPOINTS[model_id] + '_int8.pt')
+
+
+def prepare_quantization(model, engine='fbgemm'):
+    """MobileNetV1 float --> model avec observers, prêt pour la calibration"""
+    torch.backends.quantized.engine = engine
+    reduce_range = engine == 'fbgemm'
+
+    qmodel = QuantizableMobileNetV1(model.cpu().eval())
+    qmodel.qconfig = get_default_qconfig(engine)
+    qconfig_relu6 = QConfig(
+        activation=ReLU6Observer.with_args(dtype=torch.quint8, reduce_range=reduce_range),
+        weight=default_per_channel_weight_observer)
+    fuse_relu6(qmodel, qconfig_relu6)
+
+    return torch.quantization.prepare(qmodel)
+
+
+def convert_quantization(qmodel, input_size=(1281, 721)):
+    """Model calibré --> model TorchScript int8 figé"""
+    qmodel = torch.quantization.convert(qmodel.eval())
+    width, height = input_size
+    with torch.no_grad():
+        traced = torch.jit.trace(qmodel, torch.zeros((1, 3, height, width)))
+    return torch.jit.freeze(traced)
+
+
+def quantize_model(model_id, calibration_inputs, output_stride=16,
+                   model_dir=MODEL_DIR, engine=None):
+    """Quantifie, calibre avec calibration_inputs, des tenseurs (1, 3, h, w)
+    préparés comme pour le model float, et sauve le model int8 à côté du .pth
+    """
+    if engine is None:
+        engine = default_engine()
+    model = load_model(model_id, output_stride=output_stride, model_dir=model_dir)
+    qmodel = prepare_quantization(model, engine)
+
+    input_size = None
+    with torch.no_grad():
+        for tensor in calibration_inputs:
+            qmodel(tensor)
+            input_size = (tensor.shape[3], tensor.shape[2])
+    assert input_size is not None, 'Pas d\'image de calibration'
+
+    int8_model = convert_quantization(qmodel, input_size)
+    path = quantized_model_path(model_id, model_dir)
+    torch.jit.save(int8_model, path)
+    print('Int8 model saved in %s' % path)
+
+    return int8_model
+
+
+def load_quantized_model(model_id, model_dir=MODEL_DIR, engine=None):
+    """Relit le model int8 sauvé par quantize_model, sur CPU uniquement"""
+
+    path = quantized_model_path(model_id, model_dir)
+    if not os.path.exists(path):
+        raise FileNotFoundError('Int8 model %s not found, create it with: '
+                                'python3 posenet_int8.py <session_dir>' % path)
+    torch.backends.quantized.engine = engine or default_engine()
+    return torch.jit.load(path, map_location='cpu')
@@ -0,0 +1,178 @@
+
+"""
+Exécution du model Posenet MobileNetV1, sur GPU ou sur CPU
+
+Un backend est appelé avec le tenseur (1, 3, h, w) préparé par PosenetInput
+et retourne les 4 sorties du model:
+    heatmaps, offsets, displacements_fwd, displacements_bwd
+
+Réglages dans la section [pose] de grande_echelle.ini:
+    backend = torch pour le model PyTorch
+              torchscript pour le model compilé, gardé dans model_dir/torchscript
+              onnx pour onnxruntime sur CPU, model exporté dans model_dir/onnx
+              int8 pour le model quantifié, sur CPU seulement, à créer avec
+                  python3 posenet_int8.py /le/dossier/de/la/session
+    device = cuda, cpu ou auto (cuda si disponible)
+    threads = nombre de threads de calcul sur CPU, 0 pour le défaut de torch
+    interop_threads = nombre de threads entre opérations, 0 idem
+    decoder = numpy pour décoder les squelettes sur le CPU,
+              torch pour les décoder sur le device, sans copier les sorties
+    max_candidates = nombre maxi de racines candidates au décodage, 0 sans limite
+"""
+
+
+import torch
+
+import posenet
+
+
+def get_device(device):
+    """'auto' --> 'cuda' si une carte NVIDIA est disponible, sinon 'cpu'"""
+
+    if device == 'auto':
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    elif device.startswith('cuda') and not torch.cuda.is_available():
+        print("Pas de GPU disponible, Posenet tourne sur le CPU")
+        device = 'cpu'
+    return device
+
+
+def set_cpu_threads(threads, interop_threads):
+    """Nombre de threads de torch sur CPU, 0 pour ne rien changer"""
+
+    if threads:
+        torch.set_num_threads(threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            # Possible une seule fois, avant tout calcul en parallèle
+            print("interop_threads ne peut plus être modifié")
+    print(f"Posenet sur CPU: {torch.get_num_threads()} threads, "
+          f"{torch.get_num_interop_threads()} interop threads")
+
+
+class TorchBackend:
+    """Le model PyTorch, exécuté en mode inférence"""
+
+    def __init__(self, model_dir, model_id=101, device='cuda',
+                 threads=0, interop_threads=0):
+
+        self.device = get_device(device)
+        if self.device == 'cpu':
+            set_cpu_threads(threads, interop_threads)
+
+        self.model = posenet.load_model(model_id, model_dir=model_dir)
+        self.model = self.model.to(self.device).eval()
+        self.output_stride = self.model.output_stride
+
+    def __call__(self, tensor):
+        with torch.inference_mode():
+            return self.model(tensor)
+
+
+class TorchScriptBackend:
+    """Le model TorchScript tracé, figé et optimisé, un par taille d'entrée.
+    Chaque model compilé est gardé sur disque, le 1er lancement le construit,
+    les suivants le relisent.
+    """
+
+    def __init__(self, model_dir, model_id=101, device='cuda',
+                 threads=0, interop_threads=0, output_stride=16):
+
+        self.device = get_device(device)
+        if self.device == 'cpu':
+            set_cpu_threads(threads, interop_threads)
+
+        self.model_dir = model_dir
+        self.model_id = model_id
+        self.output_stride = output_stride
+        # {(largeur, hauteur): model compilé}
+        self.models = {}
+
+    def get_model(self, input_size):
+        if input_size not in self.models:
+            self.models[input_size] = posenet.load_compiled_model(
+                                                self.model_id,
+                                                self.output_stride,
+                                                input_size,
+                                                self.device,
+                                                self.model_dir)
+        return self.models[input_size]
+
+    def __call__(self, tensor):
+        model = self.get_model((tensor.shape[3], tensor.shape[2]))
+        with torch.inference_mode():
+            return model(tensor)
+
+
+class Int8Backend:
+    """Le model quantifié en int8, calibré sur une session enregistrée.
+    Les convolutions int8 ne tournent que sur CPU.
+    """
+
+    def __init__(self, model_dir, model_id=101, device='cpu',
+                 threads=0, interop_threads=0, output_stride=16):
+
+        if device != 'cpu':
+            print("Le model int8 tourne sur le CPU")
+        self.device = 'cpu'
+        set_cpu_threads(threads, interop_threads)
+
+        self.model = posenet.load_quantized_model(model_id, model_dir)
+        self.output_stride = output_stride
+
+    def __call__(self, tensor):
+        with torch.inference_mode():
+            return self.model(tensor)
+
+
+class OnnxBackend:
+    """Le model exporté en ONNX, exécuté par onnxruntime sur CPU.
+    Les 4 sorties sont des arrays numpy, que decode_multiple_poses accepte.
+    """
+
+    def __init__(self, model_dir, model_id=101, device='cpu',
+                 threads=0, interop_threads=0, output_stride=16):
+
+        import onnxruntime as ort
+
+        if device != 'cpu':
+            print("Le model onnx tourne sur le CPU")
+        self.device = 'cpu'
+        self.output_stride = output_stride
+
+        path = posenet.export_onnx(model_id, output_stride, model_dir)
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        if interop_threads:
+            options.inter_op_num_threads = interop_threads
+        self.session = ort.InferenceSession(path, options,
+                                            providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        print(f"Posenet onnxruntime {ort.__version__} sur CPU: {path}")
+
+    def __call__(self, tensor):
+        # Le tenseur CPU de PosenetInput, vu en numpy sans copie
+        return self.session.run(None, {self.input_name: tensor.numpy()})
+
+
+BACKENDS = {'torch': TorchBackend,
+            'torchscript': TorchScriptBackend,
+            'int8': Int8Backend,
+            'onnx': OnnxBackend}
+
+
+def get_backend(model_dir, config, model_id=101):
+    """Retourne le backend défini dans la section [pose] de config,
+    pour le model MobileNetV1 model_id: 50, 75, 100 ou 101
+    """
+    pose = config['pose']
+    return BACKENDS[pose['backend']](model_dir,
+                                     model_id=model_id,
+                                     device=pose['device'],
+                                     threads=int(pose['threads']),
+                                     interop_threads=int(pose['interop_threads']))
@@ -0,0 +1,166 @@
+
+"""
+Création du model Posenet quantifié en int8, pour le backend int8 sur CPU
+
+Le model est calibré sur les images d'une session enregistrée avec
+my_replay.py, puis comparé au model float sur d'autres images de la même
+session: squelettes trouvés, écarts en pixels des keypoints, temps de calcul.
+
+    python3 posenet_int8.py /le/dossier/de/la/session [nbr_calibration] [input_scale]
+
+Le model est sauvé dans posenet/mobilenet_v1_101_int8.pt, puis utilisé avec
+backend = int8 dans la section [pose] de grande_echelle.ini
+"""
+
+
+import os
+import sys
+from time import time
+
+import numpy as np
+import torch
+
+import posenet
+from my_replay import ReplayPipeline
+from my_posenet_pytorch import PosenetInput
+
+
+MODEL_ID = 101
+THRESHOLD_POSE = 0.15
+THRESHOLD_POINTS = 0.3
+
+
+def session_images(pipeline, indexes):
+    """Les images couleur de la session, aux index demandés"""
+    for i in indexes:
+        yield pipeline.color[i]
+
+
+def calibration_tensors(posenet_input, pipeline, indexes):
+    for img in session_images(pipeline, indexes):
+        yield posenet_input.process(img)
+
+
+def decode(model, posenet_input, img, output_stride):
+    """Retourne pose_scores, keypoint_scores, keypoint_coords, temps du model"""
+
+    with torch.inference_mode():
+        tensor = posenet_input.process(img)
+        t = time()
+        heatmaps, offsets, displacement_fwd, displacement_bwd = model(tensor)
+        dt = time() - t
+        a = posenet.decode_multiple_poses_vectorized(heatmaps.squeeze(0),
+                                                     offsets.squeeze(0),
+                                                     displacement_fwd.squeeze(0),
+                                                     displacement_bwd.squeeze(0),
+                                                     output_stride=output_stride,
+                                                     max_pose_detections=4,
+                                                     min_pose_score=THRESHOLD_POSE)
+    pose_scores, keypoint_scores, keypoint_coords = a
+    keypoint_coords *= posenet_input.scale
+    good = pose_scores > 0
+
+    return pose_scores[good], keypoint_scores[good], keypoint_coords[good], dt
+
+
+def match_poses(coords_ref, coords):
+    """Appariement glouton des squelettes par distance moyenne des keypoints
+    Retourne la liste des (index ref, index)
+    """
+    if not len(coords_ref) or not len(coords):
+        return []
+
+    dist = np.linalg.norm(coords_ref[:, np.newaxis] - coords[np.newaxis], axis=-1)
+    dist = dist.mean(axis=-1)
+    pairs = []
+    for _ in range(min(dist.shape)):
+        i, j = np.unravel_index(np.argmin(dist), dist.shape)
+        pairs.append((i, j))
+        dist[i, :] = np.inf
+        dist[:, j] = np.inf
+
+    return pairs
+
+
+def accuracy_report(model_float, model_int8, posenet_input, pipeline, indexes,
+                    output_stride):
+    """Compare le model int8 au model float sur les images indexes"""
+
+    errors = []
+    nbr_float, nbr_int8, nbr_matched = 0, 0, 0
+    points_float, points_int8 = 0, 0
+    times_float, times_int8 = [], []
+
+    for img in session_images(pipeline, indexes):
+        _, ks_ref, coords_ref, dt_ref = decode(model_float, posenet_input, img,
+                                               output_stride)
+        _, ks, coords, dt = decode(model_int8, posenet_input, img, output_stride)
+        times_float.append(dt_ref)
+        times_int8.append(dt)
+        nbr_float += len(coords_ref)
+        nbr_int8 += len(coords)
+
+        for i, j in match_poses(coords_ref, coords):
+            nbr_matched += 1
+            ok_ref = ks_ref[i] > THRESHOLD_POINTS
+            ok = ks[j] > THRESHOLD_POINTS
+            points_float += np.count_nonzero(ok_ref)
+            points_int8 += np.count_nonzero(ok)
+            both = ok_ref & ok
+            errors.extend(np.linalg.norm(coords_ref[i][both] - coords[j][both],
+                                         axis=-1))
+
+    errors = np.array(errors)
+    print(f"\nComparaison float / int8 sur {len(indexes)} images")
+    print(f"    Squelettes float: {nbr_float}, int8: {nbr_int8}, "
+          f"appariés: {nbr_matched}")
+    print(f"    Keypoints valides float: {points_float}, int8: {points_int8}")
+    if len(errors):
+        print(f"    Ecart des keypoints en pixels: "
+              f"moyenne {np.mean(errors):.2f}, "
+              f"médiane {np.median(errors):.2f}, "
+              f"p95 {np.percentile(errors, 95):.2f}, "
+              f"maxi {np.max(errors):.2f}")
+    print(f"    Temps du model float: {1000*np.median(times_float):.1f} ms, "
+          f"int8: {1000*np.median(times_int8):.1f} ms")
+
+
+def main(session_dir, nbr_calibration=100, input_scale=1.0):
+
+    model_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'posenet')
+    pipeline = ReplayPipeline(session_dir, speed=0)
+
+    # Images de calibration et images de comparaison, entrelacées
+    nbr_calibration = min(nbr_calibration, pipeline.nbr // 2)
+    step = pipeline.nbr // nbr_calibration
+    calibration = list(range(0, pipeline.nbr, step))[:nbr_calibration]
+    evaluation = [i + step//2 for i in calibration if i + step//2 < pipeline.nbr]
+    if step < 2:
+        evaluation = calibration
+    print(f"Calibration sur {len(calibration)} images")
+
+    model_float = posenet.load_model(MODEL_ID, model_dir=model_dir).eval()
+    output_stride = model_float.output_stride
+    posenet_input = PosenetInput(pipeline.width, pipeline.height, output_stride,
+                                 'cpu', input_scale)
+
+    model_int8 = posenet.quantize_model(MODEL_ID,
+                                        calibration_tensors(posenet_input,
+                                                            pipeline,
+                                                            calibration),
+                                        output_stride=output_stride,
+                                        model_dir=model_dir)
+
+    accuracy_report(model_float, model_int8, posenet_input, pipeline,
+                    evaluation, output_stride)
+
+
+
+if __name__ == "__main__":
+
+    session_dir = sys.argv[1]
+    nbr_calibration = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    input_scale = float(sys.argv[3]) if len(sys.argv) > 3 else 1.0
+
+    main(session_dir, nbr_calibration, input_scale)
@@ -26,9 +26,14 @@ from threading import Thread
 import numpy as np
 import cv2
 
-import pyrealsense2 as rs
 from my_realsense import MyRealSense
 from edges import EDGES
+from depth_sampler import DepthSampler
+from deprojection import Deprojector, project_points
+from sparse_align import SparseAligner
+from tracker import Tracker
+from keypoint_flow import KeypointFlow
+from presence import PresenceDetector
 
 from my_posenet_pytorch import MyPosenetPytorch
 from gestures_detection import gestures_detection_run
@@ -51,6 +56,10 @@ class PosenetRealsenseViewer:
 
         self.img = None
 
+        # Latence entre la capture et l'envoi de la profondeur
+        self.latence = 0
+        self.nbr_latence = 0
+
         self.mode_expo = int(self.config['grandeechelle']['mode_expo'])
         self.full_screen = int(self.config['grandeechelle']['full_screen'])
         if self.mode_expo:
@@ -94,7 +103,26 @@ class PosenetRealsenseViewer:
         # Calcul du FPS, affichage toutes les 10 s
         if time() - self.t0 > 10:
             print("FPS Posenet =", self.nbr/10)
+            if self.mailbox:
+                print("Captures perdues =", self.mailbox.dropped)
+                self.mailbox.dropped = 0
+            if self.nbr_latence:
+                latence = int(1000*self.latence/self.nbr_latence)
+                print(f"Latence capture --> depth = {latence} ms")
+            if self.controller:
+                model_id, scale = self.controller.current
+                print(f"Posenet model {model_id}, échelle {scale}")
+            if self.single_frames:
+                print(f"Une personne: {self.single_fallbacks} décodages "
+                      f"complets sur {self.single_frames} images")
+                self.single_frames, self.single_fallbacks = 0, 0
+            if self.flow:
+                print(f"Posenet sur {self.flow.inferences} images, flot "
+                      f"optique sur {self.flow.propagations}, "
+                      f"N = {self.flow.skip}")
+                self.flow.inferences, self.flow.propagations = 0, 0
             self.t0, self.nbr = time(), 0
+            self.latence, self.nbr_latence = 0, 0
 
         k = cv2.waitKey(1)
 
@@ -117,7 +145,7 @@ class PosenetRealsenseViewer:
 
 class PosenetRealsense(MyRealSense, MyPosenetPytorch, PosenetRealsenseViewer):
     """ Capture avec  Camera RealSense D455
-        Détection de la pose avec PyTorch sur CUDA
+        Détection de la pose avec PyTorch sur CUDA ou CPU
         Calcul des coordonnées 3D
             et envoi de la moyenne des profondeurs pour 1 personnage.
         La profondeur est le 3ème dans les coordonnées d'un point 3D,
@@ -145,9 +173,9 @@ class PosenetRealsense(MyRealSense, MyPosenetPytorch, PosenetRealsenseViewer):
 
         # Celui détecté
         self.who = None
-
-        if self.conn:
-            self.from_gui_receive_thread()
+        # Squelettes et centres retenus de la dernière image
+        self.skelets = None
+        self.centers = None
 
         self.config = config
 
@@ -162,7 +190,7 @@ class PosenetRealsense(MyRealSense, MyPosenetPytorch, PosenetRealsenseViewer):
             print("Le dossier des model n'existe pas.")
         else:
             print("Le dossier des model existe.")
-        MyPosenetPytorch.__init__(self, model_dir)
+        MyPosenetPytorch.__init__(self, model_dir, self.config)
 
         self.img_without_skelets = None
 
@@ -170,11 +198,98 @@ class PosenetRealsense(MyRealSense, MyPosenetPytorch, PosenetRealsenseViewer):
         self.threshold_points = float(self.config['pose']['threshold_points'])
         self.threshold_pose = float(self.config['pose']['threshold_pose'])
 
+        # Profondeur des keypoints: patch autour du point et valeurs supprimées
+        self.depth_sampler = DepthSampler(
+                                    int(self.config['pose']['depth_around']),
+                                    int(self.config['pose']['depth_trim']),
+                                    self.depth_scale)
+        # Les rayons de tous les pixels, calculés une fois pour toutes
+        self.deprojector = Deprojector(self.depth_intrinsic)
+        # Profondeur non alignée, seuls les keypoints sont alignés
+        self.sparse_aligner = None
+        if not self.align_frames:
+            self.sparse_aligner = SparseAligner(self.depth_intrinsic,
+                                                self.depth_raw_intrinsic,
+                                                self.color_to_depth,
+                                                self.depth_to_color,
+                                                self.depth_scale)
+
         # Pour éliminer les poses trops loin, trop près, trop large en mmm
         self.profondeur_maxi = int(self.config['grandeechelle']['profondeur_maxi'])
         self.profondeur_mini = int(self.config['grandeechelle']['profondeur_mini'])
         self.largeur_maxi = int(self.config['grandeechelle']['largeur_maxi'])
 
+        # Les racines hors de la zone ne sont pas décodées par posenet
+        # zone_margin en mm pour les keypoints loin du centre du squelette
+        # zone_depth en mm, profondeur où sont projetées les colonnes
+        self.zone_filter = int(self.config['pose']['zone_filter'])
+        self.zone_margin = int(self.config['pose']['zone_margin'])
+        self.zone_depth = int(self.config['pose']['zone_depth'])
+        if self.zone_filter:
+            self.root_filter = self.root_in_zone
+        self.zone_columns = self.get_zone_columns()
+
+        # Suivi des personnes, who ne saute plus de l'un à l'autre
+        self.tracker = None
+        if int(self.config['tracker']['tracking']):
+            tc = self.config['tracker']
+            self.tracker = Tracker(float(tc['max_distance']),
+                                   float(tc['max_age']),
+                                   float(tc['hysteresis']),
+                                   int(tc['switch_frames']),
+                                   float(tc['keypoint_radius']),
+                                   float(tc['overlap_weight']))
+        self.track_ids = None
+
+        # Posenet sur une découpe carrée autour de who, de crop_size pixels
+        # avant input_scale, et sur l'image entière toutes les crop_full_delay s
+        self.crop = int(self.config['pose']['crop'])
+        self.crop_size = int(self.config['pose']['crop_size'])
+        self.crop_margin = float(self.config['pose']['crop_margin'])
+        self.crop_full_delay = float(self.config['pose']['crop_full_delay'])
+        if self.tracker:
+            # Les autres que who ne sont vus que sur l'image entière: leurs
+            # tracks doivent être mis à jour avant max_age, même avec une
+            # image de retard
+            self.crop_full_delay = min(self.crop_full_delay,
+                                       self.tracker.max_age/2)
+        # Instant de la dernière image entière
+        self.crop_full_time = 0
+        self.crop_box = None
+
+        # Cascade: posenet sur l'image entière réduite à cascade_scale, puis à
+        # input_scale sur le carré autour de who seulement
+        self.cascade = int(self.config['pose']['cascade'])
+        self.cascade_scale = float(self.config['pose']['cascade_scale'])
+        self.refine_box = None
+
+        # Veille sans personne dans la zone: pas de posenet, seule la
+        # profondeur brute est lue, la fenêtre est rafraîchie à idle_fps
+        self.presence = None
+        self.idle = 0
+        self.idle_shown = 0
+        if int(self.config['presence']['gate']):
+            # Profondeur non alignée avec l'alignement des seuls keypoints
+            intrinsic = self.depth_intrinsic
+            if self.sparse_aligner:
+                intrinsic = self.depth_raw_intrinsic
+            self.presence = PresenceDetector(
+                                    intrinsic,
+                                    self.depth_scale,
+                                    int(self.config['presence']['step']),
+                                    int(self.config['presence']['min_pixels']),
+                                    float(self.config['presence']['leave_delay']),
+                                    self.depth_idle_intrinsic)
+            self.idle_fps = float(self.config['presence']['idle_fps'])
+
+        # Posenet une image sur N, flot optique des keypoints entre les deux
+        self.flow = None
+        if int(self.config['pose']['skip']):
+            self.flow = KeypointFlow(int(self.config['pose']['skip_max']),
+                                     float(self.config['pose']['skip_motion_low']),
+                                     float(self.config['pose']['skip_motion_high']),
+                                     float(self.config['pose']['skip_min_ratio']))
+
         # Zoom
         self.decalage2000 = int(self.config['zoom']['decalage2000'])
         self.decalage8000 = int(self.config['zoom']['decalage8000'])
@@ -185,6 +300,12 @@ class PosenetRealsense(MyRealSense, MyPosenetPytorch, PosenetRealsenseViewer):
         self.mode_expo = int(self.config['grandeechelle']['mode_expo'])
 
         self.depth = 1
+        self.x = 0
+
+        # Après le model et le contrôleur, tous les réglages reçus du GUI
+        # existent déjà
+        if self.conn:
+            self.from_gui_receive_thread()
 
     def from_gui_receive_thread(self):
         print("Lancement du thread from_gui_receive")
@@ -201,7 +322,7 @@ class PosenetRealsense(MyRealSense, MyPosenetPytorch, PosenetRealsenseViewer):
                     print("Alerte: Quit reçu dans PosenetRealsense")
                     self.pose_conn_loop = 0
                     self.pose_loop = 0
-                    self.pipeline.stop()
+                    self.stop_pipeline()
 
                 elif data[0] == 'threshold_pose':
                     print('threshold_pose reçu dans posenet:', data[1])
@@ -211,9 +332,17 @@ class PosenetRealsense(MyRealSense, MyPosenetPytorch, PosenetRealsenseViewer):
                     print('threshold_points reçu dans posenet:', data[1])
                     self.threshold_points = data[1]
 
+                elif data[0] == 'input_scale':
+                    print('input_scale reçu dans posenet:', data[1])
+                    if self.controller:
+                        print("input_scale ignoré en mode adaptatif")
+                    else:
+                        self.scale_factor = data[1]
+
                 elif data[0] == 'profondeur_mini':
                     print('profondeur_mini reçu dans posenet::', data[1])
                     self.profondeur_mini = data[1]
+                    self.zone_columns = self.get_zone_columns()
 
                 elif data[0] == 'profondeur_maxi':
                     print('profondeur_maxi reçu dans posenet::', data[1])
@@ -222,6 +351,7 @@ class PosenetRealsense(MyRealSense, MyPosenetPytorch, PosenetRealsenseViewer):
                 elif data[0] == 'largeur_maxi':
                     print('largeur_maxi reçu dans posenet:', data[1])
                     self.largeur_maxi = data[1]
+                    self.zone_columns = self.get_zone_columns()
 
                 elif data[0] == 'mode_expo':
                     print('mode_expo reçu dans posenet:', data[1])
@@ -248,157 +378,330 @@ class PosenetRealsense(MyRealSense, MyPosenetPytorch, PosenetRealsenseViewer):
     def get_only_skelets_in_zone_and_valable(self):
         """Elimination des squelettes pas dans la zone
                 profondeur mini à maxi et dans largeur_maxi
-        et qui ne sont pas [None]*17
+        et sans aucun point 3D
+        """
+        x, z = self.centers[:, 0], self.centers[:, 2]
+        # Les centres nan sont hors zone
+        with np.errstate(invalid='ignore'):
+            keep = (self.profondeur_mini < z) & (z < self.profondeur_maxi) &\
+                   (np.abs(x) < self.largeur_maxi)
+        keep &= self.skelets.valid_3D.any(axis=1)
+
+        self.skelets = self.skelets.subset(keep)
+        self.centers = self.centers[keep]
+
+    def get_zone_columns(self):
+        """Les x mini et maxi dans l'image de la zone d'interaction:
+        largeur_maxi + zone_margin de chaque côté, projetée à zone_depth.
+        A profondeur_mini, la zone est en général plus large que l'image, et
+        les colonnes n'éliminent rien. A zone_depth, les passants sur les
+        côtés de la salle sont écartés, mais aussi une personne dans la zone
+        plus près que zone_depth et sur le bord. Calculé au lancement et
+        quand profondeur_mini ou largeur_maxi changent.
+        """
+        if not self.zone_filter:
+            return None
+
+        z = max(self.zone_depth, self.profondeur_mini, 100)/1000
+        x = (self.largeur_maxi + self.zone_margin)/1000
+        points = np.array([[-x, 0, z], [x, 0, z]])
+        u = project_points(self.depth_intrinsic, points)[:, 0]
+        return u.min(), u.max()
+
+    def root_in_zone(self, root_yxs):
+        """root_yxs = array (N, 2) des y, x des racines dans l'image
+        Retourne un array (N,) bool, False pour les racines dont la profondeur
+        est hors de profondeur_mini - zone_margin, profondeur_maxi + zone_margin
+        ou dont le x est au delà de largeur_maxi + zone_margin.
+        Sans profondeur, la racine est gardée.
         """
-        skelets_2D, skelets_3D, centers = [], [], []
-
-        for i in range(len(self.skelets_2D)):
-            # Si il n'y a pas de centre, il n'y a pas de personnage
-            if self.centers[i]:
-                # Entre mini maxi
-                if self.profondeur_mini < self.centers[i][2] < self.profondeur_maxi:
-                    # Pas trop écarté
-                    if abs(self.centers[i][0]) < self.largeur_maxi:
-                        # Squelette 3D valide, ne devrait pas arrivé si self.centers[i]
-                        if self.skelets_3D[i] != [None]*17:
-                            skelets_2D.append(self.skelets_2D[i])
-                            skelets_3D.append(self.skelets_3D[i])
-                            centers.append(self.centers[i])
-
-        self.skelets_2D = skelets_2D
-        self.skelets_2D = skelets_2D
-        self.centers = centers
+        xys = root_yxs[:, np.newaxis, ::-1].astype(np.int64)
+        valid = np.ones(xys.shape[:2], dtype=bool)
+        # Recherche plus large que la zone, pour trouver ceux qui en sont hors
+        profondeurs = self.get_profondeurs(xys, valid,
+                                           max(self.profondeur_mini - self.zone_margin, 100),
+                                           2*self.profondeur_maxi)[:, 0]*1000
+
+        # x en mm de chaque racine à sa profondeur
+        x = self.deprojector.lift(xys, profondeurs[:, np.newaxis]/1000)[:, 0, 0]
+
+        with np.errstate(invalid='ignore'):
+            inside = (profondeurs > self.profondeur_mini - self.zone_margin) &\
+                     (profondeurs < self.profondeur_maxi + self.zone_margin) &\
+                     (np.abs(x) < self.largeur_maxi + self.zone_margin)
+        return inside | np.isnan(profondeurs)
+
+    def get_profondeurs(self, xys, valid, depth_min=None, depth_max=None):
+        """xys = array (N, 17, 2) int des x, y dans l'image couleur
+        valid = array (N, 17) bool
+        depth_min, depth_max = plage de recherche en mm sans alignement,
+                               par défaut profondeur_mini, profondeur_maxi
+        Retourne array (N, 17) des profondeurs en m, nan si pas trouvée
+        """
+        if self.sparse_aligner:
+            if depth_min is None:
+                depth_min, depth_max = self.profondeur_mini, self.profondeur_maxi
+            # Les keypoints de l'image couleur dans la profondeur non alignée
+            depth_xys, valid = self.sparse_aligner.color_to_depth_pixels(
+                                                        self.depth_data,
+                                                        xys, valid,
+                                                        depth_min,
+                                                        depth_max)
+            profondeurs = self.depth_sampler.sample(self.depth_data,
+                                                    depth_xys, valid)
+            profondeurs = self.sparse_aligner.depth_to_color_z(depth_xys,
+                                                               profondeurs)
+        else:
+            profondeurs = self.depth_sampler.sample(self.depth_data, xys, valid,
+                                                    (self.width, self.height))
+        return profondeurs
 
     def get_skelets_3D(self):
-        """A partir des squelettes 2D détectés dans l'image,
-        retourne les squelettes 3D
+        """Ajoute aux squelettes 2D détectés dans l'image leurs points 3D,
+        profondeurs et points 3D de tous les keypoints en 1 fois
         """
-        skelets_3D = []
-        for xys in self.skelets_2D:
-            if xys is not None:
-                pts = self.get_points_3D(xys)
-                # pts ne peut pas être [None]*17
-                skelets_3D.append(pts)
-        return skelets_3D
-
-    def get_points_3D(self, xys):
-        """Trouve les points 3D pour les squelettes xys"""
-        # Les coordonnées des 17 points 3D avec qq None
-        points_3D = [None]*17
-
-        # Parcours des squelettes
-        for i, xy in enumerate(xys):
-            if xy:
-                x = xy[0]
-                y = xy[1]
-                # Calcul de la profondeur du point
-                profondeur = self.get_profondeur_du_point(x, y)
-                if profondeur:
-                    # Calcul les coordonnées 3D avec x et y coordonnées dans
-                    # l'image et la profondeur du point
-                    # Changement du nom de la fonction trop long
-                    point_2D_to_3D = rs.rs2_deproject_pixel_to_point
-                    point_with_deph = point_2D_to_3D(self.depth_intrinsic,
-                                                     [x, y],
-                                                     profondeur)
-                    # Conversion des m en mm
-                    points_3D[i] = [int(1000*x) for x in point_with_deph]
-
-        return points_3D
-
-    def get_profondeur_du_point(self, x, y):
-        """Calcul la moyenne des profondeurs des pixels autour du point considéré
-        Filtre les absurdes et les trop loins
-        """
-        profondeur = None
-        distances = []
-        # around = nombre de pixel autour du points
-        x_min = max(x - 1, 0)
-        x_max = min(x + 1, self.depth_frame.width)
-        y_min = max(y - 1, 0)
-        y_max = min(y + 1, self.depth_frame.height)
-
-        for u in range(x_min, x_max):
-            for v in range(y_min, y_max):
-                # Profondeur du point de coordonnée (u, v) dans l'image
-                distances.append(self.depth_frame.get_distance(u, v))
-
-        # Si valeurs non trouvées, retourne [0.0, 0.0, 0.0, 0.0]
-        # Remove the item 0.0 for all its occurrences
-        dists = [i for i in distances if i != 0.0]
-        dists_sort = sorted(dists)
-        if len(dists_sort) > 2:
-            # Suppression du plus petit et du plus grand
-            goods = dists_sort[1:-1]
-            # TODO: rajouter un filtre sur les absurdes ?
-
-            # Calcul de la moyenne des profondeur
-            profondeur = get_average_list_with_None(goods)
-
-        return profondeur
+        xys, valid = self.skelets.xys, self.skelets.valid
+        profondeurs = self.get_profondeurs(xys, valid)
+        points = self.deprojector.lift(xys, profondeurs)
+        self.skelets.set_points(points, valid & ~np.isnan(profondeurs))
 
     def get_who(self):
-        """Détermination du squelette au centre
-        self.centers = [[x, y , z], ...]
-        all_x =    [-0.5, 0.8, 0.6]
-        abs_all_x = [0.5, 0.8, 0.6]
+        """Détermination du squelette au centre, le plus petit abs(x),
+        ou celui suivi par le tracker
+        self.centers = array (N, 3) des x, y, z
         """
-        if self.centers:
-            # Recherche de celui au centre
-            all_x = [c[0] for c in self.centers]
-            abs_all_x = [abs(c[0]) for c in self.centers]
-
-            if abs_all_x:  # si abs_all_x is not [], alors all_x est aussi
-                mini = min(abs_all_x)
-                # Index du mini des abs est le même que all_x
-                self.who = abs_all_x.index(mini)
-                self.depth = self.centers[self.who][2]
-                # La position en x pour affichage
-                self.x =  self.centers[self.who][0]
+        if self.tracker:
+            self.who = self.tracker.who
+        elif len(self.centers):
+            self.who = int(np.argmin(np.abs(self.centers[:, 0])))
+        else:
+            self.who = None
+
+        if self.who is not None:
+            self.depth = self.centers[self.who][2]
+            # La position en x pour affichage
+            self.x = self.centers[self.who][0]
         else:
             self.who, self.depth, self.x = None, 0, self.x
 
-    def from_all_xys_to_who(self, outputs):
+    def from_all_xys_to_who(self, skelets, refine=False):
         """ Appelé depuis la boucle infinie run()
-        outputs = all_xys
+        skelets = Skelets de compute_image
+        refine = True pour préciser who à pleine résolution, si skelets
+                 vient de la passe réduite
         """
-        self.skelets_2D, self.skelets_3D, self.centers = None, None, None
+        self.skelets, self.centers = None, None
 
         # Récupération de tous les squelettes
-        if outputs:
-            # liste des squelettes 2D, un squelette = dict de 17 keypoints
-            self.skelets_2D = outputs
-            # Ajout de la profondeur pour 3D, et capture des couleurs
-            # Liste des squelettes 3D, un squelette = list de 17 keypoints
-            # un keypoint = liste de 3 coordonnées
-            self.skelets_3D = self.get_skelets_3D()
+        if skelets:
+            self.skelets = skelets
+            # Ajout de la profondeur pour 3D
+            self.get_skelets_3D()
             # Calcul de tous les centres
-            self.centers = get_center_3D(self.skelets_3D)
+            self.centers = self.skelets.centers_3D()
 
-            # Tri des squelettes dans la zone acceptable et pas tout None
+            # Tri des squelettes dans la zone acceptable et avec points 3D
             self.get_only_skelets_in_zone_and_valable()
 
-            # self.skelets_2D est trié ici, ce n'est pas le même que ci-dessus
-            if self.skelets_2D:
-                # Détermination du squelette au centre
-                self.get_who()
+        # Le tracker vieillit aussi sans personne
+        if self.tracker:
+            self.track_ids = self.tracker.update(self.skelets, self.centers,
+                                                 self.frame_time)
+
+        # self.skelets est trié ici, ce n'est pas le même que ci-dessus
+        if self.skelets:
+            # Détermination du squelette au centre
+            self.get_who()
 
-                # Envoi au GUI
-                if self.conn and self.depth:
-                    self.conn.send(['depth raw', int(self.depth)])
+            # Keypoints de who précis, pour la profondeur et le zoom
+            if refine and self.who is not None:
+                self.refine_who()
 
-                # Dessin
-                self.draw_all_poses()
+            # Envoi au GUI
+            if self.conn and self.depth:
+                self.conn.send(['depth raw', int(self.depth)])
+                self.latence += time() - self.frame_time
+                self.nbr_latence += 1
+
+            # Dessin
+            self.draw_all_poses()
 
     def frame_compute(self):
-        # ############### Posenet
-        outputs = self.compute_image(self.img,
-                                     self.threshold_pose,
-                                     self.threshold_points)
+        # ############### Posenet, ou flot optique entre 2 posenet
+        inference = True
+        if self.flow:
+            self.flow.new_frame(self.img)
+            inference = self.flow.need_inference()
+
+        self.crop_box, self.refine_box = None, None
+        refine = False
+        if inference:
+            outputs = None
+            # Posenet sur la découpe autour de who, sauf toutes les
+            # crop_full_delay s pour trouver les nouveaux
+            if self.crop and\
+                    self.frame_time - self.crop_full_time < self.crop_full_delay:
+                outputs = self.compute_crop()
+            if not outputs:
+                if self.cascade:
+                    # Passe réduite sur l'image entière, puis who précisé
+                    outputs = self.compute_image(self.img,
+                                                 self.threshold_pose,
+                                                 self.threshold_points,
+                                                 self.cascade_scale)
+                    refine = True
+                else:
+                    outputs = self.compute_image(self.img,
+                                                 self.threshold_pose,
+                                                 self.threshold_points)
+                self.crop_full_time = self.frame_time
+        else:
+            outputs = self.flow.propagate()
 
         # Recherche du bon squelette au centre
         # Ajoute les squelettes dans l'image self.img
-        self.from_all_xys_to_who(outputs)
+        self.from_all_xys_to_who(outputs, refine)
+
+        # Seuls les squelettes dans la zone sont suivis par le flot
+        if self.flow:
+            self.flow.update(self.skelets, inference)
+
+        # La cible du décodage d'une seule personne à l'image suivante
+        if self.single:
+            self.single_target = self.get_single_target()
+
+        for box in (self.crop_box, self.refine_box):
+            if box:
+                x0, y0, x1, y1 = box
+                cv2.rectangle(self.img, (x0, y0), (x1, y1), [0, 255, 255], 1)
+
+    def get_crop_box(self):
+        """La découpe carrée autour de who, prévu dans cette image par le
+        tracker, ou à sa place dans l'image précédente.
+        Le côté est la taille du zoom à sa profondeur, ou plus si ses
+        keypoints débordent.
+        Retourne (x0, y0, x1, y1) dans l'image, ou None
+        """
+        if self.tracker:
+            track = self.tracker.who_track
+            if track is None:
+                return None
+            xys, valid = track.predict_xys(self.frame_time), track.valid
+            depth = track.predict(self.frame_time)[2]
+        else:
+            if not self.skelets or self.who is None:
+                return None
+            xys = self.skelets.xys[self.who]
+            valid = self.skelets.valid[self.who]
+            depth = self.depth
+
+        return self.get_square_box(xys, valid, depth)
+
+    def get_square_box(self, xys, valid, depth, step=1):
+        """Le carré autour des keypoints xys valides d'un perso à depth mm,
+        de la taille du zoom, ou plus si ses keypoints débordent,
+        côté arrondi au multiple de step supérieur.
+        Retourne (x0, y0, x1, y1) dans l'image, ou None
+        """
+        if not valid.any() or not depth > 0:
+            return None
+
+        points = xys[valid]
+        x_min, y_min = points.min(axis=0)
+        x_max, y_max = points.max(axis=0)
+        side = max(self.get_taille_zoom(depth),
+                   self.crop_margin*max(x_max - x_min, y_max - y_min))
+        side = step*int(np.ceil(side/step))
+
+        # Carrée et dans l'image, décalée plutôt que coupée sur les bords
+        height, width = self.img.shape[:2]
+        side = int(min(side, width, height))
+        x0 = int(np.clip((x_min + x_max - side)/2, 0, width - side))
+        y0 = int(np.clip((y_min + y_max - side)/2, 0, height - side))
+
+        return x0, y0, x0 + side, y0 + side
+
+    def refine_who(self):
+        """Posenet à input_scale sur le carré autour de who trouvé par la
+        passe réduite, ses keypoints remplacent ceux de la passe réduite.
+        Le carré est à sa taille dans l'image, arrondie à 64 pixels pour
+        ne pas réallouer l'entrée de posenet à chaque image.
+        """
+        xys = self.skelets.xys[self.who]
+        valid = self.skelets.valid[self.who]
+        box = self.get_square_box(xys, valid, self.depth, 64)
+        if box is None:
+            return
+
+        x0, y0, x1, y1 = box
+        refined = self.compute_images([self.img[y0:y1, x0:x1]],
+                                      self.threshold_pose,
+                                      self.threshold_points,
+                                      (x1 - x0, y1 - y0))[0]
+        if not refined:
+            return
+        refined.xys += (x0, y0)
+
+        # Le squelette de la découpe le plus proche de who, d'autres
+        # peuvent y être
+        both = refined.valid & valid
+        gaps = np.linalg.norm(refined.xys - xys, axis=-1)
+        n = np.count_nonzero(both, axis=1)
+        gaps = np.sum(gaps, axis=1, where=both)/np.maximum(n, 1)
+        gaps[n < 3] = np.inf
+        best = int(np.argmin(gaps))
+        if gaps[best] > (x1 - x0)/8:
+            return
+
+        coarse = self.skelets.subset([self.who])
+        self.skelets.xys[self.who] = refined.xys[best]
+        self.skelets.scores[self.who] = refined.scores[best]
+        self.skelets.valid[self.who] = refined.valid[best]
+        self.get_skelets_3D()
+        center = self.skelets.centers_3D()[self.who]
+        if not np.isfinite(center[[0, 2]]).all():
+            # Sans profondeur, la passe réduite est gardée
+            self.skelets.xys[self.who] = coarse.xys[0]
+            self.skelets.scores[self.who] = coarse.scores[0]
+            self.skelets.valid[self.who] = coarse.valid[0]
+            self.get_skelets_3D()
+            return
+
+        self.centers[self.who] = center
+        self.depth = center[2]
+        self.x = center[0]
+        self.refine_box = box
+
+        # Le track de who suit la pose précise, pas celle de la passe réduite
+        if self.tracker:
+            self.tracker.refine_who(center, self.skelets.xys[self.who],
+                                    self.skelets.valid[self.who])
+
+    def compute_crop(self):
+        """Posenet sur la découpe autour de who seulement,
+        retourne les Skelets en coordonnées de l'image, ou None
+        """
+        crop_box = self.get_crop_box()
+        if crop_box is None:
+            return None
+
+        x0, y0, x1, y1 = crop_box
+        skelets = self.compute_images([self.img[y0:y1, x0:x1]],
+                                      self.threshold_pose,
+                                      self.threshold_points,
+                                      (self.crop_size, self.crop_size))[0]
+        skelets.xys += (x0, y0)
+        self.crop_box = crop_box
+
+        return skelets
+
+    def get_single_target(self):
+        """Les keypoints de who dans l'image, en y, x, ou None si personne"""
+
+        if not self.skelets or self.who is None:
+            return None
+        return (self.skelets.xys[self.who, :, ::-1].astype(np.float64),
+                self.skelets.valid[self.who])
 
     def run(self):
         """Boucle infinie, quitter avec Echap dans la fenêtre OpenCV"""
@@ -406,26 +709,43 @@ class PosenetRealsense(MyRealSense, MyPosenetPytorch, PosenetRealsenseViewer):
         t0 = time()
         self.nbr = 0
 
+        self.start_capture()
+
         while self.pose_loop:
             self.nbr += 1
 
             # ############### RealSense
-            frames = self.pipeline.wait_for_frames(timeout_ms=80)
-
-            # Align the depth frame to color frame
-            aligned_frames = self.align.process(frames)
-
-            color = aligned_frames.get_color_frame()
-            self.depth_frame = aligned_frames.get_depth_frame()
+            # En veille, img est None et la profondeur brute
+            img, self.depth_data, self.frame_time = self.get_frames()
+            if self.depth_data is None:
+                continue
 
-            if not self.depth_frame and not color:
+            # Personne dans la zone: veille, testée sur chaque capture
+            if self.presence:
+                present = self.presence.update(self.depth_data,
+                                               self.frame_time,
+                                               self.profondeur_mini,
+                                               self.profondeur_maxi,
+                                               self.largeur_maxi,
+                                               img is None)
+                if present == self.idle:
+                    self.set_idle(not present)
+                if self.idle:
+                    self.idle_viewer(img)
+                    continue
+
+            # Capture brute encore dans la boîte à la fin de la veille
+            if img is None:
                 continue
+            self.img = img
 
-            color_data = color.as_frame().get_data()
-            self.img = np.asanyarray(color_data)
             # L'image brute sans squelette pour y extraire le zoom
             self.img_without_skelets = self.img.copy()
 
+            # Enregistrement de la session pour la relecture
+            if self.recorder:
+                self.recorder.add(self.img, self.depth_data)
+
             # Posenet
             self.frame_compute()
 
@@ -439,27 +759,63 @@ class PosenetRealsense(MyRealSense, MyPosenetPytorch, PosenetRealsenseViewer):
             # Affichage
             self.viewer()
 
-    def draw_all_poses(self):
-        for i, skelet in enumerate(self.skelets_2D):
-            if skelet:
-                if i == self.who:
-                    color = [0, 255, 0]
-                else:
-                    color = [0, 0, 255]
-                self.draw_pose(skelet, color)
+        if self.recorder:
+            self.recorder.close()
+
+    def idle_viewer(self, img):
+        """Affichage en veille de la dernière image couleur, rafraîchi à
+        idle_fps pour garder la fenêtre et les touches
+        """
+        if img is not None:
+            self.img = img.copy()
+            cv2.putText(self.img, "Veille", (30, 60),
+                        cv2.FONT_HERSHEY_SIMPLEX, 1.5, (0, 255, 255), 2)
+
+        if time() - self.idle_shown >= 1/self.idle_fps:
+            self.idle_shown = time()
+            self.viewer()
+
+    def set_idle(self, idle):
+        """Entrée ou sortie de veille, relayée par le GUI à GesturesDetection
+        pour qu'il ralentisse aussi
+        En veille, la capture ne lit plus que la profondeur brute.
+        """
+        self.idle = int(idle)
+        self.set_raw_frames(bool(self.idle))
+        if self.idle:
+            print("Personne dans la zone: veille")
+            # Rien à suivre au réveil
+            self.skelets, self.who, self.single_target = None, None, None
+            if self.flow:
+                self.flow.skelets = None
+        else:
+            print("Présence dans la zone: fin de veille")
+        if self.conn:
+            self.conn.send(['idle', self.idle])
 
-    def draw_pose(self, xys, color):
+    def draw_all_poses(self):
+        for i in range(len(self.skelets)):
+            if i == self.who:
+                color = [0, 255, 0]
+            else:
+                color = [0, 0, 255]
+            self.draw_pose(self.skelets.xys[i], self.skelets.valid[i], color)
+            # Identifiant du tracker au dessus du squelette
+            if self.track_ids is not None:
+                xys = self.skelets.xys[i][self.skelets.valid[i]]
+                x, y = int(xys[:, 0].min()), int(xys[:, 1].min()) - 10
+                cv2.putText(self.img, str(self.track_ids[i]), (x, y),
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.8, color, 2)
+
+    def draw_pose(self, xys, valid, color):
         """Affiche les points 2D, et les 'os' dans l'image pour un acteur
-        xys = [[790, 331], [780, 313], None,  ... ]
+        xys = array (17, 2) des x, y, valid = array (17,) bool
         """
         # Dessin des points
-        for point in xys:
-            if point:
-                x = point[0]
-                y = point[1]
-                cv2.circle(self.img, (x, y), 5, color=(100, 100, 100),
-                                                                  thickness=-1)
-                cv2.circle(self.img, (x, y), 6, color=color, thickness=1)
+        for x, y in xys[valid].tolist():
+            cv2.circle(self.img, (x, y), 5, color=(100, 100, 100),
+                                                              thickness=-1)
+            cv2.circle(self.img, (x, y), 6, color=color, thickness=1)
 
         # Dessin des os
         for a, b in EDGES:
@@ -467,14 +823,24 @@ class PosenetRealsense(MyRealSense, MyPosenetPytorch, PosenetRealsenseViewer):
             b = b.value  # 0 à 16
 
             # Os seulement entre keypoints esxistants
-            if not xys[a] or not xys[b] :
+            if not valid[a] or not valid[b]:
                 continue
 
             # Les 2 keypoints existent
-            ax, ay = xys[a]
-            bx, by = xys[b]
+            ax, ay = xys[a].tolist()
+            bx, by = xys[b].tolist()
             cv2.line(self.img, (ax, ay), (bx, by), color, 2)
 
+    def get_taille_zoom(self, depth):
+        """Taille en pixels du zoom sur un perso à depth en mm"""
+
+        # taille de la fenêtre à telle profondeur
+        mini, d_min = self.size2000, 2000  # 600, 2000
+        maxi, d_max = self.size8000, 8000  # 200, 8000
+
+        a, b = get_a_b(d_min, mini, d_max, maxi)
+        return int(a*depth + b)
+
     def get_perso_zoom(self, image):
         """Zoom sur la capture posenet,
         qui est au centre du perso dans la vue 2D
@@ -483,8 +849,8 @@ class PosenetRealsense(MyRealSense, MyPosenetPytorch, PosenetRealsenseViewer):
         self.img est l'image avec skelet
         """
 
-        if self.skelets_2D:
-            centre = get_center_2D(self.skelets_2D[self.who])
+        if self.skelets and self.who is not None:
+            centre = [int(c) for c in self.skelets.centers_2D()[self.who]]
 
             # ############### Décalage vers le bas car jambes mal détectées
             # décalage à telle profondeur
@@ -497,13 +863,7 @@ class PosenetRealsense(MyRealSense, MyPosenetPytorch, PosenetRealsenseViewer):
             centre[1] += dec
 
             # ############### Calcul de la taille du zoom en fonction de depth
-            # taille de la fenêtre à telle profondeur
-            mini, d_min = self.size2000, 2000  # 600, 2000
-            maxi, d_max = self.size8000, 8000  # 200, 8000
-
-            a, b = get_a_b(d_min, mini, d_max, maxi)
-            # Taille du zoom
-            taille = int(a*self.depth + b)
+            taille = self.get_taille_zoom(self.depth)
 
             # Dessin du zoom r,s à u,v
             x, y = centre[0], centre[1]
@@ -534,73 +894,6 @@ def get_a_b(x1, y1, x2, y2):
     return a, b
 
 
-def get_center_2D(skelet):
-    """Calcule le centre du skelet 2D dans l'image,
-    retourne les positions x, y du centre dans l'image.
-    """
-    center = []
-    for i in range(2):
-        center.append(get_moyenne(skelet, i))
-    return center
-
-
-def get_center_3D(skelets_3D):
-    """Retourne la liste des centres des squelettes 3D
-    en coordonnées xyz dans l'espace en mm.
-    x = latérale
-    y = verticale
-    z = profondeur
-    """
-    centers = []
-    for skelet in skelets_3D:
-        if skelet != [None]*17:
-            center = []
-            for i in range(3):
-                center.append(get_moyenne(skelet, i))
-            centers.append(center)
-        else:
-            centers.append(None)
-
-    return centers
-
-
-def get_moyenne(points, indice):
-    """Calcul la moyenne d'une coordonnée des points,
-    x = latérale
-    y = verticale
-    z = profondeur
-    indice = 0 pour x, 1 pour y, 2 pour z
-    """
-    somme = 0
-    n = 0
-    for i in range(17):
-        if points[i]:
-            p = points[i][indice]
-            if p:
-                n += 1
-                somme += p
-    if n != 0:
-        moyenne = int(somme/n)
-    else:
-        moyenne = None
-
-    return moyenne
-
-
-def get_average_list_with_None(liste):
-    """Calcul de la moyenne des valeurs de la liste, sans tenir compte des None.
-    liste = list de int ou float
-    liste = [1, 2, None, ..., 10.0, None]
-
-    Retourne un float
-    Si la liste ne contient que des None, retourne None
-    """
-    # dtype permet d'accepter les None
-    liste_array = np.array(liste, dtype=np.float64)
-
-    return np.nanmean(liste_array)
-
-
 def posenet_realsense_run(conn, current_dir, config):
     """Pour lancer ce script depuis le GUI en multiprocessing"""
 
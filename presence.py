@@ -0,0 +1,78 @@
+
+"""
+Détection de présence dans la zone d'interaction, sur la seule profondeur
+
+L'image de profondeur est réduite en ne gardant qu'un pixel sur step dans
+chaque direction. Un pixel est dans la zone si sa profondeur est entre
+profondeur_mini et profondeur_maxi, et son x entre -largeur_maxi et
+largeur_maxi, en mm. Quelqu'un est présent dès que min_pixels pixels réduits
+sont dans la zone, absent après leave_delay s sans assez de pixels.
+
+En veille, la profondeur est brute, sans décimation ni alignement, avec ses
+propres intrinsics: update(..., raw=True). Le décalage entre les capteurs
+profondeur et couleur, quelques cm, est négligeable ici.
+
+Pas de posenet sans personne: voir la veille dans posenet_realsense.py
+"""
+
+
+import numpy as np
+
+from deprojection import deproject_pixels
+
+
+class PresenceDetector:
+
+    def __init__(self, intrinsic, depth_scale, step=8, min_pixels=40,
+                 leave_delay=3, raw_intrinsic=None):
+        """intrinsic = intrinsics de l'image de profondeur reçue,
+        raw_intrinsic = celles de la profondeur brute de la veille,
+        depth_scale = profondeur en m par unité z16
+        """
+        self.intrinsics = {False: intrinsic,
+                           True: raw_intrinsic if raw_intrinsic else intrinsic}
+        self.depth_scale = depth_scale
+        self.step = step
+        self.min_pixels = min_pixels
+        self.leave_delay = leave_delay
+
+        # x du rayon de chaque pixel réduit, calculé à la 1ère image, pour la
+        # profondeur reçue et pour la brute
+        self.rays_x = {}
+
+        self.present = False
+        self.last_seen = 0
+        # Nombre de pixels dans la zone à la dernière image, pour info
+        self.count = 0
+
+    def get_rays_x(self, shape, raw=False):
+        """x des rayons des pixels réduits, array (h/step, w/step)"""
+
+        v, u = np.mgrid[0:shape[0]:self.step, 0:shape[1]:self.step]
+        pixels = np.stack((u, v), axis=-1).astype(np.float64)
+        return deproject_pixels(self.intrinsics[raw], pixels)[..., 0]
+
+    def update(self, depth, t, profondeur_mini, profondeur_maxi, largeur_maxi,
+               raw=False):
+        """depth = array (h, w) z16 de l'image de profondeur
+        t = instant de la capture en s
+        raw = True pour la profondeur brute de la veille
+        Retourne True si quelqu'un est dans la zone
+        """
+        if raw not in self.rays_x:
+            self.rays_x[raw] = self.get_rays_x(depth.shape, raw)
+
+        # En mm
+        z = depth[::self.step, ::self.step]*(self.depth_scale*1000)
+        x = self.rays_x[raw]*z
+        inside = (z > profondeur_mini) & (z < profondeur_maxi) &\
+                 (np.abs(x) < largeur_maxi)
+        self.count = np.count_nonzero(inside)
+
+        if self.count >= self.min_pixels:
+            self.present = True
+            self.last_seen = t
+        elif t - self.last_seen > self.leave_delay:
+            self.present = False
+
+        return self.present
@@ -0,0 +1,84 @@
+
+"""
+Les squelettes d'une image en arrays numpy, du décodage posenet jusqu'au
+dessin et au zoom, sans listes de listes de points.
+
+    xys = array (N, 17, 2) int des x, y dans l'image couleur
+    scores = array (N, 17) des scores des keypoints
+    valid = array (N, 17) bool, keypoints au dessus de threshold_points
+    points = array (N, 17, 3) int des x, y, z en mm, 0 si pas de profondeur
+    valid_3D = array (N, 17) bool, keypoints avec profondeur
+
+x = latérale, y = verticale, z = profondeur
+"""
+
+
+import numpy as np
+
+
+class Skelets:
+    """N squelettes de 17 keypoints, en 2D dans l'image et en 3D en mm"""
+
+    def __init__(self, xys, scores, valid, points=None, valid_3D=None):
+
+        self.xys = xys
+        self.scores = scores
+        self.valid = valid
+
+        n = len(xys)
+        if points is None:
+            points = np.zeros((n, 17, 3), dtype=np.int64)
+            valid_3D = np.zeros((n, 17), dtype=bool)
+        self.points = points
+        self.valid_3D = valid_3D
+
+    @classmethod
+    def from_keypoints(cls, keypoint_scores, keypoint_coords, score_mini):
+        """Depuis la sortie du décodeur
+        keypoint_scores = array (N, 17)
+        keypoint_coords = array (N, 17, 2) des y, x dans l'image
+        Les keypoints avec un score <= score_mini ne sont pas valides,
+        les squelettes sans aucun keypoint valide sont supprimés.
+        """
+        valid = keypoint_scores > score_mini
+        keep = valid.any(axis=1)
+        xys = keypoint_coords[keep][:, :, ::-1].astype(np.int64)
+
+        return cls(xys, keypoint_scores[keep], valid[keep])
+
+    def __len__(self):
+        return len(self.xys)
+
+    def subset(self, keep):
+        """Les squelettes keep, array (N,) bool ou index"""
+
+        return Skelets(self.xys[keep], self.scores[keep], self.valid[keep],
+                       self.points[keep], self.valid_3D[keep])
+
+    def set_points(self, points, valid_3D):
+        """points = array (N, 17, 3) en mm, nan si pas de profondeur"""
+
+        self.valid_3D = valid_3D & self.valid
+        self.points = np.where(self.valid_3D[:, :, np.newaxis],
+                               points, 0).astype(np.int64)
+
+    def centers_2D(self):
+        """Array (N, 2) des centres x, y dans l'image"""
+        return get_centers(self.xys, self.valid)
+
+    def centers_3D(self):
+        """Array (N, 3) des centres x, y, z en mm"""
+        return get_centers(self.points, self.valid_3D)
+
+
+def get_centers(coords, valid):
+    """Moyenne de chaque coordonnée des keypoints valides de chaque squelette
+    coords = array (N, 17, C), valid = array (N, 17) bool
+    Les coordonnées nulles sont ignorées, comme une profondeur absente.
+    Retourne array (N, C) tronqué à l'entier, nan si aucun point.
+    """
+    mask = valid[:, :, np.newaxis] & (coords != 0)
+    n = np.count_nonzero(mask, axis=1)
+    somme = np.sum(coords, axis=1, where=mask, dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.trunc(somme/n)
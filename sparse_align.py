@@ -0,0 +1,113 @@
+
+"""
+Alignement de la profondeur sur la couleur pour les seuls keypoints
+
+Au lieu d'aligner toute l'image de profondeur avec rs.align, chaque keypoint
+de l'image couleur est cherché dans l'image de profondeur non alignée, comme
+rs2_project_color_pixel_to_depth_pixel de librealsense:
+    le pixel couleur est déprojeté à depth_min et à depth_max, les 2 points
+    sont projetés dans l'image de profondeur, et sur le segment entre les 2,
+    le pixel retenu est celui qui se reprojette au plus près du pixel couleur.
+
+Tous les keypoints de tous les squelettes sont traités en une fois avec numpy.
+"""
+
+
+import numpy as np
+
+from deprojection import Deprojector, project_points
+
+
+def extrinsics_to_array(extrinsics):
+    """rs.extrinsics vers la matrice de rotation (3, 3) et la translation (3,)
+    en m. La rotation de librealsense est rangée par colonnes.
+    """
+    rotation = np.array(extrinsics.rotation, dtype=np.float64).reshape(3, 3).T
+    translation = np.array(extrinsics.translation, dtype=np.float64)
+    return rotation, translation
+
+
+class SparseAligner:
+    """Correspondance pixels couleur --> pixels de profondeur non alignée"""
+
+    def __init__(self, color_intrinsic, depth_intrinsic,
+                 color_to_depth, depth_to_color, depth_scale=0.001):
+        """color_to_depth, depth_to_color = rs.extrinsics entre les 2 capteurs
+        """
+        self.color_intrinsic = color_intrinsic
+        self.depth_intrinsic = depth_intrinsic
+        self.c2d_rotation, self.c2d_translation = extrinsics_to_array(color_to_depth)
+        self.d2c_rotation, self.d2c_translation = extrinsics_to_array(depth_to_color)
+        self.depth_scale = depth_scale
+
+        # Les rayons des pixels des 2 images
+        self.color_rays = Deprojector(color_intrinsic).rays
+        self.depth_rays = Deprojector(depth_intrinsic).rays
+
+    def color_to_depth_pixels(self, depth, xys, valid, depth_min, depth_max):
+        """depth = array (h, w) uint16 de l'image de profondeur non alignée
+        xys = array (N, 17, 2) int des x, y dans l'image couleur
+        valid = array (N, 17) bool
+        depth_min, depth_max = plage de recherche en mm
+
+        Retourne depth_xys = array (N, 17, 2) int des x, y dans l'image de
+        profondeur, et found = array (N, 17) bool
+        """
+        h, w = depth.shape[:2]
+        hc, wc = self.color_rays.shape[:2]
+
+        u = np.clip(xys[..., 0], 0, wc - 1)
+        v = np.clip(xys[..., 1], 0, hc - 1)
+        rays = np.ones(xys.shape[:-1] + (3,))
+        rays[..., :2] = self.color_rays[v, u]
+
+        # Le segment de recherche dans l'image de profondeur
+        start = self.to_depth_image(rays*depth_min/1000, w, h)
+        end = self.to_depth_image(rays*depth_max/1000, w, h)
+
+        # Pas de 1 pixel sur le plus grand côté du segment
+        lengths = np.maximum(np.abs(end - start).max(axis=-1), 1)
+        steps = int(np.ceil(lengths[valid].max())) if valid.any() else 1
+        f = np.minimum(np.arange(steps + 1) / lengths[..., np.newaxis], 1)
+        line = start[..., np.newaxis, :] + \
+               (end - start)[..., np.newaxis, :]*f[..., np.newaxis]
+        pu = line[..., 0].astype(np.int64)
+        pv = line[..., 1].astype(np.int64)
+
+        # Reprojection dans l'image couleur de chaque pixel du segment
+        z = depth[pv, pu]*self.depth_scale
+        points = np.ones(pu.shape + (3,))
+        points[..., :2] = self.depth_rays[pv, pu]
+        points *= z[..., np.newaxis]
+        points = points @ self.d2c_rotation.T + self.d2c_translation
+        projected = project_points(self.color_intrinsic, points)
+
+        dist = np.sum((projected - xys[..., np.newaxis, :])**2, axis=-1)
+        dist[(z == 0) | np.isnan(dist)] = np.inf
+        best = np.argmin(dist, axis=-1)[..., np.newaxis]
+
+        found = valid & np.isfinite(np.take_along_axis(dist, best, axis=-1)[..., 0])
+        depth_xys = np.stack((np.take_along_axis(pu, best, axis=-1)[..., 0],
+                              np.take_along_axis(pv, best, axis=-1)[..., 0]),
+                             axis=-1)
+
+        return depth_xys, found
+
+    def to_depth_image(self, points, w, h):
+        """Points 3D du repère couleur en m --> pixels de l'image de profondeur,
+        ramenés dans l'image
+        """
+        points = points @ self.c2d_rotation.T + self.c2d_translation
+        pixels = project_points(self.depth_intrinsic, points)
+        pixels[..., 0] = np.clip(pixels[..., 0], 0, w - 1)
+        pixels[..., 1] = np.clip(pixels[..., 1], 0, h - 1)
+        return pixels
+
+    def depth_to_color_z(self, depth_xys, profondeurs):
+        """Profondeurs en m mesurées dans l'image de profondeur -->
+        profondeurs en m dans le repère de la couleur, comme après rs.align
+        """
+        points = np.ones(depth_xys.shape[:-1] + (3,))
+        points[..., :2] = self.depth_rays[depth_xys[..., 1], depth_xys[..., 0]]
+        points *= profondeurs[..., np.newaxis]
+        return points @ self.d2c_rotation[2] + self.d2c_translation[2]
@@ -0,0 +1,259 @@
+
+"""
+Suivi des personnes d'une image à l'autre, avec un identifiant persistant
+
+Chaque personne suivie est un Track: centre 3D en mm, keypoints 2D, vitesses
+et instant de la dernière détection. A chaque image, les squelettes sont
+appariés aux tracks avec un coût:
+
+    distance entre le centre prévu du track et le centre du squelette,
+    divisée par max_distance
+    + overlap_weight * (1 - part des keypoints communs à moins de
+                        keypoint_radius pixels de leur position prévue)
+
+Les appariements au delà de max_distance sont impossibles. Un squelette non
+apparié crée un track, un track non vu depuis max_age s est supprimé.
+
+who est le track suivi, celui au centre en x. Il ne change que si un autre est
+plus près du centre de plus de hysteresis mm pendant switch_frames images de
+suite, ou s'il disparaît. Si who est recalculé plus précisément après
+update(), refine_who() remplace sa détection dans son track.
+"""
+
+
+from itertools import count
+
+import numpy as np
+
+
+class Track:
+    """Une personne suivie"""
+
+    def __init__(self, track_id, center, xys, valid, t):
+        """center = array (3,) en mm
+        xys = array (17, 2) des x, y dans l'image, valid = array (17,) bool
+        t = instant de la détection en s
+        """
+        self.id = track_id
+        self.center = center
+        self.xys = xys.astype(np.float64)
+        self.valid = valid
+        # mm/s et pixels/s
+        self.velocity = np.zeros(3)
+        self.velocity_2D = np.zeros(2)
+        self.last_seen = t
+        self.hits = 1
+        # Index du squelette de ce track dans l'image en cours, ou None
+        self.index = None
+        # L'état avant la dernière détection, pour la remplacer
+        self.previous = None
+
+    def predict(self, t):
+        """Centre prévu à l'instant t en mm"""
+        return self.center + self.velocity*(t - self.last_seen)
+
+    def predict_xys(self, t):
+        """Keypoints prévus à l'instant t dans l'image, array (17, 2)"""
+        return self.xys + self.velocity_2D*(t - self.last_seen)
+
+    def update(self, center, xys, valid, t, smoothing):
+        """Nouvelle détection, les vitesses sont lissées"""
+
+        self.previous = (self.center, self.xys, self.valid, self.velocity,
+                         self.velocity_2D, self.last_seen, self.hits)
+        dt = t - self.last_seen
+        if dt > 0:
+            velocity = (center - self.center)/dt
+            self.velocity = smoothing*self.velocity + (1 - smoothing)*velocity
+            # Déplacement moyen des keypoints vus dans les 2 images
+            both = valid & self.valid
+            if both.any():
+                move = np.mean(xys[both] - self.xys[both], axis=0)
+                self.velocity_2D = smoothing*self.velocity_2D +\
+                                   (1 - smoothing)*move/dt
+
+        self.center = center
+        self.xys = xys.astype(np.float64)
+        self.valid = valid
+        self.last_seen = t
+        self.hits += 1
+
+    def refine(self, center, xys, valid, smoothing):
+        """La dernière détection remplacée par une plus précise, les vitesses
+        sont recalculées depuis l'état d'avant
+        """
+        if self.previous is None:
+            # Track créé par cette détection
+            self.center = center
+            self.xys = xys.astype(np.float64)
+            self.valid = valid
+            return
+
+        t = self.last_seen
+        (self.center, self.xys, self.valid, self.velocity, self.velocity_2D,
+         self.last_seen, self.hits) = self.previous
+        self.update(center, xys, valid, t, smoothing)
+
+
+class Tracker:
+
+    def __init__(self, max_distance=600, max_age=0.5, hysteresis=300,
+                 switch_frames=15, keypoint_radius=40, overlap_weight=0.5,
+                 smoothing=0.5):
+        """max_distance en mm, max_age en s, hysteresis en mm,
+        keypoint_radius en pixels
+        """
+        self.max_distance = max_distance
+        self.max_age = max_age
+        self.hysteresis = hysteresis
+        self.switch_frames = switch_frames
+        self.keypoint_radius = keypoint_radius
+        self.overlap_weight = overlap_weight
+        self.smoothing = smoothing
+
+        self.tracks = []
+        self.ids = count()
+
+        self.who_id = None
+        # Celui qui pourrait remplacer who, et depuis combien d'images
+        self.challenger_id = None
+        self.challenger_frames = 0
+
+    def get_costs(self, skelets, centers, t):
+        """Array (nombre de tracks, nombre de squelettes) des coûts,
+        inf si l'appariement est impossible
+        """
+        predicted = np.array([track.predict(t) for track in self.tracks])
+        distances = np.linalg.norm(predicted[:, np.newaxis] - centers[np.newaxis],
+                                   axis=-1)/self.max_distance
+
+        predicted_xys = np.array([track.predict_xys(t) for track in self.tracks])
+        predicted_valid = np.array([track.valid for track in self.tracks])
+        gaps = np.linalg.norm(predicted_xys[:, np.newaxis] - skelets.xys[np.newaxis],
+                              axis=-1)
+        both = predicted_valid[:, np.newaxis] & skelets.valid[np.newaxis]
+        close = both & (gaps < self.keypoint_radius)
+        overlap = np.count_nonzero(close, axis=-1) /\
+                  np.maximum(np.count_nonzero(both, axis=-1), 1)
+
+        costs = distances + self.overlap_weight*(1 - overlap)
+        # nan si centre sans x, y, z
+        costs[~(distances <= 1)] = np.inf
+
+        return costs
+
+    def update(self, skelets, centers, t):
+        """skelets = Skelets de l'image, dans la zone, ou None
+        centers = array (N, 3) de leurs centres en mm
+        t = instant de la capture en s
+        Retourne array (N,) des id des tracks de chaque squelette
+        """
+        n = len(skelets) if skelets else 0
+        ids = np.zeros(n, dtype=np.int64)
+        for track in self.tracks:
+            track.index = None
+
+        matched = set()
+        if n and self.tracks:
+            costs = self.get_costs(skelets, centers, t)
+            # Appariement glouton, du plus petit coût au plus grand
+            for _ in range(min(costs.shape)):
+                i, j = np.unravel_index(np.argmin(costs), costs.shape)
+                if costs[i, j] == np.inf:
+                    break
+                track = self.tracks[i]
+                track.update(centers[j], skelets.xys[j], skelets.valid[j], t,
+                             self.smoothing)
+                track.index = j
+                ids[j] = track.id
+                matched.add(j)
+                costs[i, :] = np.inf
+                costs[:, j] = np.inf
+
+        # Les tracks perdus depuis trop longtemps
+        self.tracks = [track for track in self.tracks
+                            if t - track.last_seen <= self.max_age]
+
+        # Les nouveaux
+        for j in range(n):
+            if j not in matched:
+                track = Track(next(self.ids), centers[j], skelets.xys[j],
+                              skelets.valid[j], t)
+                track.index = j
+                ids[j] = track.id
+                self.tracks.append(track)
+
+        self.update_who()
+
+        return ids
+
+    def update_who(self):
+        """who reste le même tant qu'il est suivi, sauf si un autre est
+        nettement plus au centre depuis switch_frames images
+        """
+        current = self.get_track(self.who_id)
+        visibles = [track for track in self.tracks if track.index is not None]
+
+        if current is None:
+            # who perdu, le plus au centre le remplace
+            self.who_id = None
+            if visibles:
+                best = min(visibles, key=lambda track: abs(track.center[0]))
+                self.who_id = best.id
+            self.challenger_id, self.challenger_frames = None, 0
+            return
+
+        # who pas vu dans cette image, il garde sa place jusqu'à max_age
+        if current.index is None or not visibles:
+            return
+
+        best = min(visibles, key=lambda track: abs(track.center[0]))
+        if best is current or\
+                abs(best.center[0]) + self.hysteresis >= abs(current.center[0]):
+            self.challenger_id, self.challenger_frames = None, 0
+            return
+
+        if best.id == self.challenger_id:
+            self.challenger_frames += 1
+        else:
+            self.challenger_id, self.challenger_frames = best.id, 1
+
+        if self.challenger_frames >= self.switch_frames:
+            self.who_id = best.id
+            self.challenger_id, self.challenger_frames = None, 0
+
+    def get_track(self, track_id):
+        """Le track track_id, ou None s'il n'existe plus"""
+
+        for track in self.tracks:
+            if track.id == track_id:
+                return track
+        return None
+
+    def refine_who(self, center, xys, valid):
+        """who recalculé plus précisément dans l'image en cours,
+        après update()
+        """
+        track = self.who_track
+        if track is not None and track.index is not None:
+            track.refine(center, xys, valid, self.smoothing)
+
+    @property
+    def who_track(self):
+        return self.get_track(self.who_id)
+
+    @property
+    def who(self):
+        """Index du squelette de who dans l'image en cours, ou None"""
+
+        track = self.who_track
+        if track is None:
+            return None
+        return track.index
+
+    def predictions(self, t):
+        """Positions prévues à l'instant t de tous les tracks:
+        liste de (id, centre (3,) en mm, keypoints (17, 2), valid (17,))
+        """
+        return [(track.id, track.predict(t), track.predict_xys(t), track.valid)
+                for track in self.tracks]